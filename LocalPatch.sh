@@ -1,112 +1,168 @@
-7z x framework.jar -oframework
-7z x services.jar -oservices
-7z x miui-services.jar -omiui_services
-7z x miui-framework.jar -omiui_framework
-
-if [ -f "framework/classes.dex" ]; then
-  java -jar baksmali.jar d -a 34 "framework/classes.dex" -o classes
-else
-  echo "framework/classes.dex not found, skipping decompile."
-fi
-
-for i in {2..5}; do
-  if [ -f "framework/classes${i}.dex" ]; then
-    java -jar baksmali.jar d -a 34 "framework/classes${i}.dex" -o "classes${i}"
-  else
-    echo "framework/classes${i}.dex not found, skipping decompile."
+# Stop at the first failure and keep the intermediates; every finished stage
+# is recorded in stages.json, and "./LocalPatch.sh --resume" skips the ones
+# whose inputs and outputs are unchanged.
+set -e
+RESUME=false
+[ "$1" = "--resume" ] && RESUME=true
+
+# stage <name> <checkpoint.py options> -- <command>: run the command unless
+# --resume finds the stage up to date, then record it
+stage() {
+  local name=$1 options=()
+  shift
+  while [ "$1" != "--" ]; do
+    options+=("$1")
+    shift
+  done
+  shift
+  if $RESUME && python3 checkpoint.py stages.json check "$name" "${options[@]}"; then
+    echo "Skipping stage $name: inputs and outputs unchanged"
+    return
   fi
-done
-
-if [ -f "services/classes.dex" ]; then
-  java -jar baksmali.jar d -a 34 "services/classes.dex" -o services_classes
-else
-  echo "services/classes.dex not found, skipping decompile."
-fi
-
-for i in {2..5}; do
-  if [ -f "services/classes${i}.dex" ]; then
-    java -jar baksmali.jar d -a 34 "services/classes${i}.dex" -o "services_classes${i}"
-  else
-    echo "services/classes${i}.dex not found, skipping decompile."
+  "$@" && python3 checkpoint.py stages.json record "$name" "${options[@]}"
+}
+
+# extract <jar dir>: the jar's dex files into <jar dir>
+extract() {
+  local jar
+  jar=$(echo "$1" | tr _ -).jar
+  stage "extract:$1" --input "$jar" --output "$1" -- 7z x "$jar" -o"$1" "classes*.dex"
+}
+
+extract framework
+extract services
+extract miui_services
+extract miui_framework
+
+# Run at most $(nproc) baksmali/smali JVMs at once; drain waits for the rest
+running=0
+spawn() {
+  "$@" &
+  running=$((running + 1))
+  if [ "$running" -ge "$(nproc)" ]; then
+    wait -n
+    running=$((running - 1))
   fi
-done
-
-java -jar baksmali.jar d -a 34 miui_services/classes.dex -o miui_services_classes
-java -jar baksmali.jar d -a 34 miui_framework/classes.dex -o miui_framework_classes
-
-python3 framework_patch.py True
-python3 services_patch.py True
-python3 miui-service_Patch.py
-python3 miui-framework_patch.py
-
-if [ -d classes ]; then
-  java -jar smali.jar a -a 34 classes -o framework/classes.dex
-else
-  echo "classes directory not found, skipping recompilation."
-fi
-
-for i in {2..5}; do
-  if [ -d "classes$i" ]; then
-    java -jar smali.jar a -a 34 "classes$i" -o "framework/classes$i.dex"
-  else
-    echo "classes$i directory not found, skipping recompilation."
-  fi
-done
-
-if [ -d services_classes ]; then
-  java -jar smali.jar a -a 34 services_classes -o services/classes.dex
-else
-  echo "services_classes directory not found, skipping recompilation."
-fi
-
-for i in {2..5}; do
-  if [ -d "services_classes$i" ]; then
-    java -jar smali.jar a -a 34 "services_classes$i" -o "services/classes$i.dex"
-  else
-    echo "services_classes$i directory not found, skipping recompilation."
-  fi
-done
-
-if [ -d miui_services_classes ]; then
-  java -jar smali.jar a -a 34 miui_services_classes -o miui_services/classes.dex
-else
-  echo "miui_services_classes directory not found, skipping recompilation."
-fi
-
-if [ -d miui_framework_classes ]; then
-  java -jar smali.jar a -a 34 miui_framework_classes -o miui_framework/classes.dex
-else
-  echo "miui_framework_classes directory not found, skipping recompilation."
-fi
-
-cd framework
-7z a -tzip ../framework_new.zip *
-cd ../services
-7z a -tzip ../services_new.zip *
-cd ../miui_services
-7z a -tzip ../miui_services_new.zip *
-cd ../miui_framework
-7z a -tzip ../miui_framework_new.zip *
-cd ..
-
-zipalign -f -p -v -z 4 framework_new.zip aligned_framework.jar
-zipalign -f -p -v -z 4 services_new.zip aligned_services.jar
-zipalign -f -p -v -z 4 miui_services_new.zip aligned_miui_services.jar
-zipalign -f -p -v -z 4 miui_framework_new.zip aligned_miui_framework.jar
-
-mkdir -p magisk_module/system/framework
-mkdir -p magisk_module/system/system_ext/framework
-cp aligned_framework.jar magisk_module/system/framework/framework.jar
-cp aligned_services.jar magisk_module/system/framework/services.jar
-cp aligned_miui_services.jar magisk_module/system/system_ext/framework/miui-services.jar
-cp aligned_miui_framework.jar magisk_module/system/system_ext/framework/miui-framework.jar
-
-cd magisk_module
-zip -r ../moded_framework_services.zip *
-
-cd ..
+}
+drain() {
+  while [ "$running" -gt 0 ]; do
+    wait -n
+    running=$((running - 1))
+  done
+}
+
+# decompile <jar dir> <smali prefix>: every classesN.dex into <prefix>N, in parallel
+decompile() {
+  for dex in "$1"/classes*.dex; do
+    if [ ! -f "$dex" ]; then
+      echo "$1 has no dex files, skipping decompile."
+      continue
+    fi
+    name=$(basename "$dex" .dex)
+    case "${name#classes}" in *[!0-9]*) continue ;; esac
+    spawn stage "disassemble:$2${name#classes}" --after "extract:$1" --param 34 --output "$2${name#classes}" -- \
+      java -jar baksmali.jar d -a 34 "$dex" -o "$2${name#classes}"
+  done
+}
+
+decompile framework classes
+decompile services services_classes
+decompile miui_services miui_services_classes
+decompile miui_framework miui_framework_classes
+drain
+
+# smali_dirs <smali prefix> <option>: "<option><prefix>N" for every smali directory of a jar
+smali_dirs() {
+  for dir in "$1"*; do
+    case "${dir#"$1"}" in *[!0-9]*) continue ;; esac
+    [ -d "$dir" ] && echo "$2$dir"
+  done
+}
+
+# patch_smali <jar dir> <smali prefix> <script> <arguments>: run a patch script over the jar's smali
+# directories; the files it changed are listed in <jar dir>_manifest.txt (--manifest)
+patch_smali() {
+  local jar=$1 prefix=$2
+  shift 2
+  # shellcheck disable=SC2046
+  stage "patch:$jar" $(smali_dirs "$prefix" "--after disassemble:") $(smali_dirs "$prefix" "--output ") --output "${jar}_manifest.txt" \
+    --input "$1" --input patch_engine.py --input method_index.py --input dex_index.py --input rule_pack.py \
+    --input tracing.py --input snapshot.py --input "rules/$jar.json" --input rules/common.json \
+    --param "$*" -- \
+    run_patch "${jar}_manifest.txt" "$@"
+}
+run_patch() {
+  local manifest=$1
+  shift
+  rm -f "$manifest"
+  touch "$manifest"
+  python3 "$@" --manifest "$manifest"
+}
+
+patch_smali framework classes framework_patch.py True --jobs "$(nproc)"
+patch_smali services services_classes services_patch.py True --jobs "$(nproc)"
+patch_smali miui_services miui_services_classes miui-service_Patch.py
+patch_smali miui_framework miui_framework_classes miui-framework_patch.py
+
+# Directories a patch script changed are listed in its manifest; the others
+# keep their original dex.
+needs_assembly() {
+  grep -q "^$1/" "$2"
+}
+
+# recompile <smali prefix> <jar dir>: every changed <prefix>N back into classesN.dex, in parallel
+recompile() {
+  for dir in "$1"*; do
+    n=${dir#"$1"}
+    case "$n" in *[!0-9]*) continue ;; esac
+    [ -d "$dir" ] || continue
+    if needs_assembly "$dir" "$2_manifest.txt"; then
+      spawn stage "assemble:$dir" --after "patch:$2" --param 34 --output "$2/classes$n.dex" -- \
+        java -jar smali.jar a -a 34 "$dir" -o "$2/classes$n.dex"
+    else
+      echo "$dir unchanged, keeping original classes$n.dex."
+    fi
+  done
+}
+
+recompile classes framework
+recompile services_classes services
+recompile miui_services_classes miui_services
+recompile miui_framework_classes miui_framework
+drain
+
+# pack <jar dir>: the stock jar with its changed dex files swapped in, aligned, as aligned_<jar dir>.jar
+pack() {
+  local jar
+  jar=$(echo "$1" | tr _ -).jar
+  stage "pack:$1" --input "$jar" --input "$1" --output "aligned_$1.jar" -- \
+    python3 jar_writer.py "$jar" "$1" "aligned_$1.jar"
+}
+
+pack framework
+pack services
+pack miui_services
+pack miui_framework
+
+module() {
+  mkdir -p magisk_module/system/framework
+  mkdir -p magisk_module/system/system_ext/framework
+  cp aligned_framework.jar magisk_module/system/framework/framework.jar
+  cp aligned_services.jar magisk_module/system/framework/services.jar
+  cp aligned_miui_services.jar magisk_module/system/system_ext/framework/miui-services.jar
+  cp aligned_miui_framework.jar magisk_module/system/system_ext/framework/miui-framework.jar
+  (cd magisk_module && zip -r ../moded_framework_services.zip *)
+}
+
+stage module --input aligned_framework.jar --input aligned_services.jar --input aligned_miui_services.jar \
+  --input aligned_miui_framework.jar --output moded_framework_services.zip -- module
+
+# Only reached when every stage succeeded
 rm -rf framework services miui_services miui_framework
-rm -rf classes classes2 classes3 classes4 classes5 services_classes services_classes2 services_classes3 services_classes4 services_classes5 miui_services_classes miui_framework_classes
-rm -rf framework_new.zip services_new.zip miui_services_new.zip miui_framework_new.zip aligned_framework.jar aligned_services.jar aligned_miui_services.jar aligned_miui_framework.jar
+rm -rf classes classes[0-9]* services_classes services_classes[0-9]* miui_services_classes miui_services_classes[0-9]*
+rm -rf miui_framework_classes miui_framework_classes[0-9]*
+rm -f framework_manifest.txt services_manifest.txt miui_services_manifest.txt miui_framework_manifest.txt
+rm -f stages.json stages.json.lock
+rm -rf aligned_framework.jar aligned_services.jar aligned_miui_services.jar aligned_miui_framework.jar
 
 echo "Cleanup complete."
\ No newline at end of file
@@ -0,0 +1,76 @@
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.File;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+import java.util.Collections;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+
+import org.jf.baksmali.Baksmali;
+import org.jf.baksmali.BaksmaliOptions;
+import org.jf.dexlib2.DexFileFactory;
+import org.jf.dexlib2.Opcodes;
+import org.jf.dexlib2.dexbacked.DexBackedDexFile;
+import org.jf.dexlib2.util.SyntheticAccessorResolver;
+import org.jf.smali.Smali;
+import org.jf.smali.SmaliOptions;
+
+/**
+ * Serves baksmali/smali jobs from one warm JVM.
+ *
+ * Requests are read from stdin, one per line, as tab-separated
+ * "id, command (d|a), api level, input, output". Each reply is written to
+ * stdout as "id\tok" or "id\terror\tmessage". Tool output goes to stderr.
+ */
+public class SmaliServer {
+    public static void main(String[] args) throws Exception {
+        int threads = args.length > 0 ? Integer.parseInt(args[0]) : Runtime.getRuntime().availableProcessors();
+        ExecutorService executor = Executors.newFixedThreadPool(threads);
+        PrintStream replies = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        System.setOut(System.err);
+
+        BufferedReader requests = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        String line;
+        while ((line = requests.readLine()) != null) {
+            String[] request = line.split("\t", -1);
+            executor.submit(() -> {
+                String reply;
+                try {
+                    reply = request[0] + (handle(request) ? "\tok" : "\terror\t" + request[1] + " reported errors");
+                } catch (Throwable t) {
+                    reply = request[0] + "\terror\t" + String.valueOf(t).replace('\n', ' ');
+                }
+                synchronized (replies) {
+                    replies.println(reply);
+                }
+            });
+        }
+        executor.shutdown();
+    }
+
+    private static boolean handle(String[] request) throws Exception {
+        int apiLevel = Integer.parseInt(request[2]);
+        String input = request[3];
+        String output = request[4];
+
+        if (request[1].equals("d")) {
+            DexBackedDexFile dexFile = DexFileFactory.loadDexFile(input, Opcodes.forApi(apiLevel));
+            BaksmaliOptions options = new BaksmaliOptions();
+            options.apiLevel = apiLevel;
+            options.syntheticAccessorResolver = new SyntheticAccessorResolver(dexFile.getOpcodes(),
+                    dexFile.getClasses());
+            return Baksmali.disassembleDexFile(dexFile, new File(output), 1, options);
+        }
+        if (request[1].equals("a")) {
+            SmaliOptions options = new SmaliOptions();
+            options.apiLevel = apiLevel;
+            options.outputDexFile = output;
+            options.jobs = 1;
+            return Smali.assemble(options, Collections.singletonList(input));
+        }
+        throw new IllegalArgumentException("Unknown command: " + request[1]);
+    }
+}
@@ -0,0 +1,175 @@
+import argparse
+import json
+import logging
+import os
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+from cache import CachedTools, ResultCache, SmaliTreeCache
+from patcher import (JARS, SCRIPT_DIR, add_jar_stages, jar_key, module_and_store, module_key, module_name,
+                     stage_manifest)
+from pipeline import Pipeline
+from smali_server import BAKSMALI_JAR, TOOL_MEMORY, JavaTools, SmaliServer, tool_slots
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Per-device settings and their defaults; the manifest's "defaults" object overrides these
+DEVICE_DEFAULTS = {"api_level": "34", "core": False, "isCN": True, "version": None}
+
+
+def parse_bool(value):
+    return value if isinstance(value, bool) else str(value).lower() == 'true'
+
+
+def device_jars(settings, base_dir):
+    """Map jar names to input paths from a device's ``jars`` object or its ``jars_dir``."""
+    if "jars" in settings:
+        unknown = [name for name in settings["jars"] if name not in JARS]
+        if unknown:
+            raise ValueError(f"Unknown jars for {settings['device']}: {', '.join(unknown)}")
+        paths = {name: os.path.join(base_dir, path) for name, path in settings["jars"].items()}
+    else:
+        jars_dir = os.path.join(base_dir, settings.get("jars_dir", settings["device"]))
+        paths = {name: os.path.join(jars_dir, spec["jar"]) for name, spec in JARS.items()}
+
+    jars = {}
+    for name, path in paths.items():
+        if os.path.exists(path):
+            jars[name] = path
+        else:
+            logging.warning(f"{path} not found, skipping it for {settings['device']}.")
+    return jars
+
+
+def load_manifest(path, options):
+    """Read the device manifest; return one options namespace per device build."""
+    with open(path) as file:
+        manifest = json.load(file)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    defaults = dict(DEVICE_DEFAULTS, **manifest.get("defaults", {}))
+
+    builds = []
+    outputs = set()
+    for entry in manifest["devices"]:
+        settings = dict(defaults, **entry)
+        build = Namespace(**vars(options))
+        build.device_name = settings["device"]
+        build.version = settings["version"]
+        build.api_level = str(settings["api_level"])
+        build.core = parse_bool(settings["core"])
+        build.isCN = parse_bool(settings["isCN"])
+        build.jars = device_jars(settings, base_dir)
+        build.output = os.path.join(options.output_dir, module_name(build.device_name, build.version))
+        if build.output in outputs:
+            raise ValueError(f"Duplicate device build in {path}: {build.device_name} {build.version}")
+        outputs.add(build.output)
+        builds.append(build)
+    return builds
+
+
+def hash_inputs(builds, jobs):
+    """Return each build's ``{jar name: jar key}``, hashing the input jars on ``jobs`` threads."""
+    tasks = [(i, name, path) for i, build in enumerate(builds) for name, path in build.jars.items()]
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        keys = list(executor.map(lambda task: jar_key(task[2], JARS[task[1]], builds[task[0]]), tasks))
+    jar_keys = [{} for _ in builds]
+    for (i, name, _), key in zip(tasks, keys):
+        jar_keys[i][name] = key
+    return jar_keys
+
+
+def build_batch_pipeline(builds, tools, work_dir, results=None, checkpoints=None, resume=False):
+    """Build one DAG for every device: each distinct input jar is patched once and shared by the modules."""
+    pipeline = Pipeline(checkpoints, resume)
+    jar_keys = hash_inputs(builds, builds[0].jobs if builds else 1)
+    unique = {}
+    modules = 0
+
+    for build, keys in zip(builds, jar_keys):
+        key = module_key(keys, build.output)
+        if results is not None and not build.rebuild and results.fetch(key, build.output):
+            logging.info(f"Module is up to date: {build.output}")
+            continue
+
+        aligned_jars = {}
+        pack_stages = []
+        for name, jar in keys.items():
+            short = jar[len("jar-"):len("jar-") + 12]
+            if jar not in unique:
+                jar_dir = os.path.join(work_dir, "jars", short)
+                aligned_jar = os.path.join(jar_dir, f"aligned_{name}.jar")
+                os.makedirs(jar_dir, exist_ok=True)
+                stage = None
+                if results is None or build.rebuild or not results.fetch(jar, aligned_jar):
+                    stage = add_jar_stages(pipeline, tools, name, build.jars[name], jar_dir, aligned_jar, build,
+                                           results, jar, tag=f"{name}@{short}")
+                unique[jar] = (aligned_jar, stage)
+            aligned_jar, stage = unique[jar]
+            aligned_jars[name] = aligned_jar
+            if stage is not None:
+                pack_stages.append(stage)
+
+        device_dir = os.path.join(work_dir, "devices", os.path.splitext(os.path.basename(build.output))[0])
+        pipeline.add(f"module:{os.path.basename(build.output)}",
+                     lambda a=aligned_jars, d=device_dir, b=build, k=key: module_and_store(a, d, b.output, results, k),
+                     pack_stages, inputs=list(aligned_jars.values()) + [os.path.join(SCRIPT_DIR, "magisk_module")],
+                     outputs=[build.output])
+        modules += 1
+
+    inputs = sum(len(keys) for keys in jar_keys)
+    logging.info(f"{len(builds)} device builds, {modules} modules to build, {inputs} input jars, "
+                 f"{len(unique)} distinct jars to patch or reuse")
+    return pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Patch many device builds at once, sharing identical jars")
+    parser.add_argument("manifest", help="JSON file listing the device builds")
+    parser.add_argument("--output-dir", default="out", help="directory for the Magisk modules")
+    parser.add_argument("--work-dir", default="build/batch", help="directory for intermediate files")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="size of the shared worker pool")
+    parser.add_argument("--all-dex", action="store_true",
+                        help="disassemble every dex instead of only those containing patch targets")
+    parser.add_argument("--backend", choices=["smali", "dex"], default="smali",
+                        help="patch dex files in place where every rule allows it, instead of via baksmali/smali")
+    parser.add_argument("--cache-dir",
+                        help="reuse disassembled smali trees and finished jars/modules cached in this directory")
+    parser.add_argument("--cache-size", type=int, default=4096, help="size cap in MiB of the whole cache dir")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="build everything again instead of reusing cached jars/modules")
+    parser.add_argument("--batch-jvm", action="store_true",
+                        help="run every baksmali/smali job in one long-lived JVM instead of one JVM per dex")
+    parser.add_argument("--tool-memory", type=int, default=TOOL_MEMORY,
+                        help="MiB one baksmali/smali job needs; caps how many run at once")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="record finished stages in the work dir's stage manifest, so --resume can skip them")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the stages recorded in the work dir's stage manifest whose inputs are unchanged "
+                             "(implies --checkpoint)")
+    tracing.add_arguments(parser)
+    options = parser.parse_args()
+    tracing.configure(options)
+
+    builds = load_manifest(options.manifest, options)
+    os.makedirs(options.work_dir, exist_ok=True)
+    os.makedirs(options.output_dir, exist_ok=True)
+
+    results = ResultCache(options.cache_dir, options.cache_size << 20) if options.cache_dir else None
+    slots = tool_slots(options.jobs, options.tool_memory)
+    if options.batch_jvm:
+        tools = SmaliServer(threads=slots, tool_memory=options.tool_memory)
+    else:
+        tools = JavaTools(max_parallel=slots)
+    if options.cache_dir:
+        tools = CachedTools(tools, SmaliTreeCache(options.cache_dir, options.cache_size << 20, BAKSMALI_JAR))
+    try:
+        with tools:
+            build_batch_pipeline(builds, tools, options.work_dir, results, stage_manifest(options),
+                                 options.resume).run(jobs=options.jobs)
+    finally:
+        tracing.write_outputs(options)
+
+
+if __name__ == "__main__":
+    main()
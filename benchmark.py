@@ -0,0 +1,315 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import tempfile
+import time
+from argparse import Namespace
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from patch_engine import (MethodBodyRule, InsertBeforeRule, InsertAfterMoveResultRule, ReplaceInMethodRule,
+                          InsertAfterRule, ReplaceStringRule, RemoveBranchRule, patch_file)
+from patcher import JARS, build_engine, load_script
+
+# Extra arguments each script's modify_smali_files takes after ``directories``
+MODIFY_ARGS = {
+    "framework": lambda options: [options.core],
+    "services": lambda options: [options.isCN],
+    "miui_services": lambda options: [],
+    "miui_framework": lambda options: [],
+}
+
+FILLER_BODY = [
+    "    iget-object v0, p0, L{cls};->mField{n}:Ljava/lang/Object;\n",
+    "    if-eqz v0, :cond_{n}\n",
+    "    invoke-virtual {{v0}}, Ljava/lang/Object;->hashCode()I\n",
+    "    move-result v1\n",
+    "    add-int/lit8 v1, v1, 0x{n:x}\n",
+    "    :cond_{n}\n",
+    "    const-string v2, \"filler string {n}\"\n",
+    "    invoke-static {{v2}}, Landroid/util/Log;->d(Ljava/lang/String;)I\n",
+]
+
+
+def sample_text(pattern):
+    """Turn one of the rules' regexes into a line it matches."""
+    text = re.sub(r'^\\\.method(\.\*)?', '.method public ', pattern).replace('.method public  ', '.method ')
+    for token, value in [(r'(v\d+)', 'v0'), (r'v\d+', 'v0'), (r'\w+', '0'), ('.*', '')]:
+        text = text.replace(token, value)
+    text = re.sub(r'\\(.)', r'\1', text)
+    if not re.search(pattern, text):
+        raise ValueError(f"Cannot build a sample line for {pattern!r}")
+    return text
+
+
+def method(declaration, body, registers=6):
+    return [declaration + "\n", f"    .registers {registers}\n", "\n"] + body + ["    return-void\n", ".end method\n", "\n"]
+
+
+def filler_method(cls, n, lines_per_method):
+    body = []
+    while len(body) < lines_per_method:
+        body += [line.format(cls=cls, n=n * 1000 + len(body)) for line in FILLER_BODY]
+    return method(f".method private filler{n}(I)V", body[:lines_per_method])
+
+
+def rule_sites(rule):
+    """Smali snippets, one per site, that ``rule`` patches."""
+    prelude = ["    invoke-custom {p0, p1}, call_site_0(Ljava/lang/Object;)Z\n"] \
+        if isinstance(rule, MethodBodyRule) and rule.requires else []
+    if isinstance(rule, MethodBodyRule):
+        return [method(sample_text(pattern.pattern), prelude + ["    const/4 v0, 0x2\n"])
+                for pattern, body in rule.methods.values()]
+    if isinstance(rule, InsertBeforeRule):
+        return [method(".method private site()V", ["    " + sample_text(rule.pattern.pattern) + "\n"])]
+    if isinstance(rule, InsertAfterMoveResultRule):
+        return [method(".method private site()Z",
+                       ["    " + sample_text(rule.pattern.pattern) + "\n", "\n", "    move-result v3\n"])]
+    if isinstance(rule, ReplaceInMethodRule):
+        return [method(sample_text(rule.method_pattern.pattern), [f"    {rule.search}\n"])]
+    if isinstance(rule, InsertAfterRule):
+        return [method(".method private site()V", ["    " + sample_text(rule.pattern.pattern) + "\n"])]
+    if isinstance(rule, ReplaceStringRule):
+        return [method(".method private site()V", [f"    const-string v0, \"{rule.search_string}\"\n"])]
+    if isinstance(rule, RemoveBranchRule):
+        return [method(".method private site()V", [
+            "    " + sample_text(rule.pattern.pattern) + "\n",
+            "    move-result-object v6\n", "    if-eqz v6, :cond_site\n", "    const/4 v1, 0x0\n",
+            "    :cond_site\n", "    nop\n"])]
+    raise ValueError(f"No site generator for {type(rule).__name__}")
+
+
+def class_lines(class_file, rules, params, rng):
+    cls = class_file[:-len(".smali")]
+    sites = [site for rule in rules for site in rule_sites(rule)]
+    target_count = max(len(sites), round(params["methods"] * params["density"])) if sites else 0
+    slots = sorted(rng.sample(range(max(params["methods"], target_count)), target_count))
+
+    lines = [f".class public L{cls};\n", ".super Ljava/lang/Object;\n", "\n"]
+    for n in range(max(params["methods"], target_count)):
+        if slots and slots[0] == n:
+            lines += sites[(target_count - len(slots)) % len(sites)]
+            slots.pop(0)
+        else:
+            lines += filler_method(cls, n, params["lines_per_method"])
+    return lines
+
+
+def generate_tree(root, name, engine, params):
+    """Write a synthetic decompiled tree for one jar; return its directories."""
+    spec = JARS[name]
+    rng = random.Random(f"{params['seed']}-{name}")
+    directories = [os.path.join(root, spec["prefix"] + (str(i) if i > 1 else ""))
+                   for i in range(1, params["dex_count"] + 1)]
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    for class_file, rules in engine.rules.items():
+        write_class(rng.choice(directories), class_file, class_lines(class_file, rules, params, rng))
+    for n in range(params["filler_files"]):
+        class_file = f"com/example/filler/Filler{n}.smali"
+        write_class(directories[n % len(directories)], class_file, class_lines(class_file, [], params, rng))
+    return directories
+
+
+def write_class(directory, class_file, lines):
+    path = os.path.join(directory, class_file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.writelines(lines)
+
+
+def measure_input(paths):
+    lines = size = 0
+    for path in paths:
+        with open(path, 'rb') as file:
+            data = file.read()
+        lines += data.count(b"\n")
+        size += len(data)
+    return lines, size
+
+
+def peak_rss_kb():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def isolated(func, *args):
+    """Run ``func(*args)`` in a fresh interpreter, so the peak RSS it reads is that case's alone.
+
+    ``ru_maxrss`` is a high-water mark over the whole life of a process;
+    read in the benchmark process it would only ever grow from case to case.
+    """
+    context = multiprocessing.get_context("spawn")
+    root = logging.getLogger()
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=root.setLevel,
+                             initargs=(root.level,)) as executor:
+        return executor.submit(func, *args).result()
+
+
+def timed(source_dirs, run_dir, func, repeat):
+    """Run ``func`` on fresh copies of ``source_dirs``; return the best wall time."""
+    best = None
+    for _ in range(repeat):
+        if os.path.exists(run_dir):
+            shutil.rmtree(run_dir)
+        directories = []
+        for source_dir in source_dirs:
+            directory = os.path.join(run_dir, os.path.basename(source_dir))
+            shutil.copytree(source_dir, directory)
+            directories.append(directory)
+        start = time.perf_counter()
+        func(directories)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def result(seconds, lines, size, hits, peak_rss):
+    return {
+        "seconds": round(seconds, 6),
+        "lines": lines,
+        "bytes": size,
+        "lines_per_s": round(lines / seconds) if seconds else None,
+        "mb_per_s": round(size / seconds / 1e6, 3) if seconds else None,
+        "hits": hits,
+        "peak_rss_kb": peak_rss,
+    }
+
+
+def find(directories, class_file):
+    return next((os.path.join(d, class_file) for d in directories if os.path.exists(os.path.join(d, class_file))), None)
+
+
+def stage_targets(engine):
+    """Map each rule name to the ``(class_file, rule)`` pairs it patches, in registration order."""
+    stages = {}
+    for class_file, rules in engine.rules.items():
+        for rule in rules:
+            stages.setdefault(rule.name, []).append((class_file, rule))
+    return stages
+
+
+def run_stage(name, stage, options, source_dirs, run_dir, repeat):
+    """Time one rule; return the best time, hits per run and peak RSS."""
+    targets = stage_targets(build_engine(JARS[name], options))[stage]
+    stats = Counter()
+
+    def run(directories):
+        for class_file, rule in targets:
+            stats.update(patch_file(find(directories, class_file), [rule]))
+
+    seconds = timed(source_dirs, run_dir, run, repeat)
+    return seconds, stats[stage] // repeat, peak_rss_kb()
+
+
+def run_all(name, jobs, options, source_dirs, run_dir, repeat):
+    """Time a full ``modify_smali_files`` run; return the best time, hits per run and peak RSS."""
+    modify_smali_files = load_script(JARS[name]["script"]).modify_smali_files
+    summary = Counter()
+
+    def run(directories):
+        summary.update(modify_smali_files(directories, *MODIFY_ARGS[name](options), jobs=jobs))
+
+    seconds = timed(source_dirs, run_dir, run, repeat)
+    return seconds, sum(summary.values()) // repeat, peak_rss_kb()
+
+
+def run_benchmarks(work_dir, params, options):
+    results = {}
+    for name, spec in JARS.items():
+        engine = build_engine(spec, options)
+        source_dirs = generate_tree(os.path.join(work_dir, "corpus", name), name, engine, params)
+        run_dir = os.path.join(work_dir, "run")
+
+        for stage, targets in stage_targets(engine).items():
+            paths = [find(source_dirs, class_file) for class_file, _ in targets]
+            seconds, hits, peak_rss = isolated(run_stage, name, stage, options, source_dirs, run_dir, params["repeat"])
+            results[f"{name}:{stage}"] = result(seconds, *measure_input(paths), hits, peak_rss)
+
+        paths = [find(source_dirs, class_file) for class_file in engine.rules]
+        for jobs in sorted({1, params["jobs"]}):
+            seconds, hits, peak_rss = isolated(run_all, name, jobs, options, source_dirs, run_dir, params["repeat"])
+            results[f"{name}:modify_smali_files:jobs={jobs}"] = result(seconds, *measure_input(paths), hits, peak_rss)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Log each benchmark against ``baseline``; return the names that got slower than ``threshold`` percent."""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            logging.info(f"{name}: new benchmark")
+            continue
+        change = (current["seconds"] - previous["seconds"]) / previous["seconds"] * 100 if previous["seconds"] else 0
+        level = logging.WARNING if change > threshold else logging.INFO
+        logging.log(level, f"{name}: {previous['seconds']:.4f}s -> {current['seconds']:.4f}s ({change:+.1f}%)")
+        if change > threshold:
+            regressions.append(name)
+        if current["hits"] != previous["hits"]:
+            logging.warning(f"{name}: hits changed from {previous['hits']} to {current['hits']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the smali patch scripts on synthetic decompiled trees")
+    parser.add_argument("--work-dir", help="where to generate the corpus (a temporary directory by default)")
+    parser.add_argument("--methods", type=int, default=400, help="methods per generated class")
+    parser.add_argument("--lines-per-method", type=int, default=24, help="instructions per filler method")
+    parser.add_argument("--density", type=float, default=0.02,
+                        help="fraction of methods in a target class that are patch sites")
+    parser.add_argument("--filler-files", type=int, default=50, help="non-target classes per jar")
+    parser.add_argument("--dex-count", type=int, default=5, help="classesN directories per jar")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark; the fastest is reported")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="also time modify_smali_files with this many workers")
+    parser.add_argument("--seed", default="0", help="corpus random seed")
+    parser.add_argument("--output", default="benchmark.json", help="where to write the results")
+    parser.add_argument("--baseline", help="compare against this earlier results file")
+    parser.add_argument("--threshold", type=float, default=10.0, help="slowdown in percent counted as a regression")
+    parser.add_argument("--verbose", action="store_true", help="keep the patch scripts' logging")
+    args = parser.parse_args()
+
+    params = {key: getattr(args, key) for key in
+              ["methods", "lines_per_method", "density", "filler_files", "dex_count", "repeat", "jobs", "seed"]}
+    options = Namespace(core=True, isCN=True)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="patch-bench-")
+    try:
+        results = run_benchmarks(work_dir, params, options)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    logging.getLogger().setLevel(logging.INFO)
+
+    for name, current in results.items():
+        logging.info(f"{name}: {current['seconds']:.4f}s, {current['lines_per_s']} lines/s, "
+                     f"{current['mb_per_s']} MB/s, {current['hits']} hits, peak RSS {current['peak_rss_kb']} KiB")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline["params"] != params:
+            logging.warning(f"Baseline was generated with different parameters: {baseline['params']}")
+        regressions = compare(results, baseline["results"], args.threshold)
+
+    with open(args.output, 'w') as file:
+        json.dump({"params": params, "results": results}, file, indent=2)
+    logging.info(f"Wrote {args.output}")
+
+    if regressions:
+        logging.error(f"{len(regressions)} benchmarks regressed by more than {args.threshold}%")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# One lock for every store: they evict from the same budget
+EVICTION_LOCK = threading.Lock()
+
+
+class LruStore:
+    """A directory of cache entries inside a cache dir, which is capped as a whole at ``max_bytes``.
+
+    Entry mtimes are bumped on every hit. Once the entries of all the stores
+    in the cache dir (every subdirectory of it) exceed the cap, the oldest
+    ones are evicted first, whichever store they belong to.
+    """
+
+    suffix = ""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key + self.suffix)
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def commit(self, temp_path, key):
+        os.replace(temp_path, self.path(key))
+        self.evict()
+
+    def entries(self):
+        """Every entry of every store in the cache dir; names starting with a dot are files being written."""
+        cache_dir = os.path.dirname(self.root)
+        entries = []
+        for store in os.listdir(cache_dir):
+            store_dir = os.path.join(cache_dir, store)
+            if store.startswith('.') or not os.path.isdir(store_dir):
+                continue
+            for name in os.listdir(store_dir):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(store_dir, name)
+                try:
+                    entries.append((os.path.getmtime(path), entry_size(path), path))
+                except FileNotFoundError:
+                    continue
+        return entries
+
+    def evict(self):
+        with EVICTION_LOCK:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                logging.info(f"Evicting cache entry: {path}")
+                remove_entry(path)
+                total -= size
+
+
+def entry_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, file)) for root, dirs, files in os.walk(path) for file in files)
+
+
+def remove_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class SmaliTreeCache(LruStore):
+    """Disassembled smali trees keyed by dex SHA-256, API level and baksmali build."""
+
+    suffix = ".zip"
+
+    def __init__(self, root, max_bytes, baksmali_jar):
+        super().__init__(os.path.join(root, "smali"), max_bytes)
+        self.tool_digest = file_digest(baksmali_jar)[:16] if os.path.exists(baksmali_jar) else "unknown"
+
+    def key(self, dex_path, api_level):
+        return f"{file_digest(dex_path)}-api{api_level}-{self.tool_digest}"
+
+    def restore(self, key, output_dir):
+        path = self.path(key)
+        try:
+            with zipfile.ZipFile(path) as archive:
+                archive.extractall(output_dir)
+        except FileNotFoundError:
+            return False
+        self.touch(path)
+        logging.info(f"Restored {output_dir} from smali cache")
+        return True
+
+    def store(self, key, source_dir):
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=".", suffix=self.suffix)
+        os.close(fd)
+        try:
+            with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+                for root, dirs, files in os.walk(source_dir):
+                    for file in files:
+                        file_path = os.path.join(root, file)
+                        archive.write(file_path, os.path.relpath(file_path, source_dir))
+            self.commit(temp_path, key)
+        except BaseException:
+            remove_entry(temp_path)
+            raise
+        logging.info(f"Stored {source_dir} in smali cache")
+
+
+class ResultCache(LruStore):
+    """Finished build outputs (aligned jars, module zips) keyed by everything that produced them."""
+
+    def __init__(self, root, max_bytes):
+        super().__init__(os.path.join(root, "results"), max_bytes)
+
+    def fetch(self, key, destination):
+        path = self.path(key)
+        try:
+            shutil.copyfile(path, destination)
+        except FileNotFoundError:
+            return False
+        self.touch(path)
+        logging.info(f"Reused cached result for {destination}")
+        return True
+
+    def store(self, key, source):
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=".")
+        os.close(fd)
+        try:
+            shutil.copyfile(source, temp_path)
+            self.commit(temp_path, key)
+        except BaseException:
+            remove_entry(temp_path)
+            raise
+
+
+class DownloadCache(LruStore):
+    """Downloaded jars keyed by their SHA-256, next to the revalidation headers of the URLs they came from."""
+
+    suffix = ".jar"
+
+    def __init__(self, root, max_bytes):
+        super().__init__(os.path.join(root, "downloads"), max_bytes)
+
+
+def fingerprint(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class CachedTools:
+    """Wraps JavaTools/SmaliServer so disassembly is served from a SmaliTreeCache."""
+
+    def __init__(self, tools, cache):
+        self.tools = tools
+        self.cache = cache
+
+    def disassemble(self, dex_path, output_dir, api_level):
+        key = self.cache.key(dex_path, api_level)
+        if self.cache.restore(key, output_dir):
+            return
+        self.tools.disassemble(dex_path, output_dir, api_level)
+        self.cache.store(key, output_dir)
+
+    def assemble(self, input_dir, dex_path, api_level):
+        self.tools.assemble(input_dir, dex_path, api_level)
+
+    def close(self):
+        self.tools.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,142 @@
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+from cache import file_digest, fingerprint
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def path_digest(path):
+    """Content hash of a file; for a directory, a hash of every file's relative path, size and mtime.
+
+    Directories are smali trees of tens of thousands of files, so they are
+    stamped from ``stat`` alone instead of being read. ``None`` if missing.
+    """
+    if os.path.isfile(path):
+        return file_digest(path)
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            stat = os.stat(file_path)
+            digest.update(f"{os.path.relpath(file_path, path)}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+    return digest.hexdigest()
+
+
+def _related(path, other):
+    return path == other or other.startswith(os.path.join(path, "")) or path.startswith(os.path.join(other, ""))
+
+
+class StageManifest:
+    """Which stages finished, with the key of their inputs and the digests of their outputs.
+
+    A stage's key is a hash of its parameters, the contents of its input
+    files and the keys of the stages it depends on, so a change anywhere
+    upstream changes every key below it. A stage is up to date when its
+    recorded key matches and its outputs still hold what it wrote (for a
+    directory: the same files, sizes and mtimes). A stage that rewrites an
+    upstream stage's outputs in place (patching a disassembled tree,
+    reassembling an extracted dex) refreshes the digests recorded for that
+    stage, so the upstream stage stays up to date while a rerun of it makes
+    the stages below it stale.
+
+    The manifest is a JSON file that several processes may update at once;
+    every change is made under an exclusive lock on ``<path>.lock``. Digests
+    are taken before it, so the lock is only held to read, change and write
+    the manifest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {"stages": {}}
+
+    def _update(self, change):
+        with self.lock, open(self.path + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            manifest = self._load()
+            change(manifest)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+            with open(fd, 'w') as file:
+                json.dump(manifest, file, indent=1, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+    def key(self, name, params=(), inputs=(), after=()):
+        manifest = self._load()
+        missing = [dep for dep in after if dep not in manifest["stages"]]
+        if missing:
+            raise KeyError(f"Stage {name} runs after stages that never finished: {', '.join(missing)}")
+        return fingerprint(name, *params, *[(os.path.normpath(path), path_digest(path)) for path in inputs],
+                           *[(dep, manifest["stages"][dep]["key"]) for dep in after])
+
+    def up_to_date(self, name, key):
+        manifest = self._load()
+        record = manifest["stages"].get(name)
+        if record is None or record["key"] != key:
+            return False
+        return all(path_digest(path) == digest for path, digest in record["outputs"].items())
+
+    def record(self, name, key, outputs=(), after=()):
+        digests = {os.path.normpath(path): path_digest(path) for path in outputs}
+        stages = self._load()["stages"]
+        upstream, pending = set(), list(after)
+        while pending:
+            dep = pending.pop()
+            if dep in stages and dep not in upstream:
+                upstream.add(dep)
+                pending += stages[dep]["after"]
+        refreshed = {(dep, path): path_digest(path) for dep in upstream for path in stages[dep]["outputs"]
+                     if any(_related(path, output) for output in digests)}
+
+        def change(manifest):
+            stages = manifest["stages"]
+            for (dep, path), digest in refreshed.items():
+                if path in stages.get(dep, {}).get("outputs", {}):
+                    stages[dep]["outputs"][path] = digest
+            stages[name] = {"key": key, "after": list(after), "outputs": digests}
+
+        self._update(change)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check or record a pipeline stage in a stage manifest")
+    parser.add_argument("manifest", help="the stage manifest (JSON)")
+    parser.add_argument("command", choices=["check", "record"],
+                        help="check: exit 0 if the stage is up to date; record: mark it finished")
+    parser.add_argument("stage", help="stage name")
+    parser.add_argument("--input", action="append", default=[], help="file or directory the stage reads")
+    parser.add_argument("--output", action="append", default=[], help="file or directory the stage writes")
+    parser.add_argument("--after", action="append", default=[], help="stage whose results this stage uses")
+    parser.add_argument("--param", action="append", default=[], help="setting that changes the stage's result")
+    args = parser.parse_args()
+
+    manifest = StageManifest(args.manifest)
+    try:
+        key = manifest.key(args.stage, args.param, args.input, args.after)
+    except KeyError as e:
+        if args.command == "check":
+            sys.exit(1)
+        raise SystemExit(str(e))
+    if args.command == "check":
+        sys.exit(0 if manifest.up_to_date(args.stage, key) else 1)
+    manifest.record(args.stage, key, args.output, args.after)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import logging
+import struct
+import zipfile
+
+DEX_MAGIC = b"dex\n"
+NO_INDEX = 0xffffffff
+
+HEADER = struct.Struct("<8sI20s20I")
+CLASS_DEF = struct.Struct("<8I")
+PROTO_ID = struct.Struct("<3I")
+METHOD_ID = struct.Struct("<HHI")
+
+METHOD_ACCESS_FLAGS = [
+    (0x1, "public"), (0x2, "private"), (0x4, "protected"), (0x8, "static"), (0x10, "final"),
+    (0x20, "synchronized"), (0x40, "bridge"), (0x80, "varargs"), (0x100, "native"), (0x400, "abstract"),
+    (0x800, "strictfp"), (0x1000, "synthetic"), (0x10000, "constructor"), (0x20000, "declared-synchronized"),
+]
+
+
+def read_uleb128(data, offset):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def decode_mutf8(data):
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        # Modified UTF-8: NUL as C0 80, supplementary characters as surrogate pairs
+        return data.replace(b"\xc0\x80", b"\x00").decode("utf-8", "surrogatepass") \
+            .encode("utf-16", "surrogatepass").decode("utf-16")
+
+
+class DexFile:
+    """Minimal read-only view of a DEX file's id tables."""
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        if bytes(self.data[:4]) != DEX_MAGIC:
+            raise ValueError("Not a dex file")
+        (self.magic, self.checksum, self.signature, self.file_size, self.header_size, self.endian_tag,
+         self.link_size, self.link_off, self.map_off, self.string_ids_size, self.string_ids_off,
+         self.type_ids_size, self.type_ids_off, self.proto_ids_size, self.proto_ids_off,
+         self.field_ids_size, self.field_ids_off, self.method_ids_size, self.method_ids_off,
+         self.class_defs_size, self.class_defs_off, self.data_size, self.data_off) = HEADER.unpack_from(self.data)
+        self._strings = {}
+
+    def u4(self, offset):
+        return struct.unpack_from("<I", self.data, offset)[0]
+
+    def string(self, index):
+        if index not in self._strings:
+            offset = self.u4(self.string_ids_off + 4 * index)
+            length, offset = read_uleb128(self.data, offset)
+            end = offset
+            while self.data[end]:
+                end += 1
+            self._strings[index] = decode_mutf8(bytes(self.data[offset:end]))
+        return self._strings[index]
+
+    def type_descriptor(self, index):
+        return self.string(self.u4(self.type_ids_off + 4 * index))
+
+    def class_defs(self):
+        for i in range(self.class_defs_size):
+            yield CLASS_DEF.unpack_from(self.data, self.class_defs_off + i * CLASS_DEF.size)
+
+    def class_descriptors(self):
+        return [self.type_descriptor(class_def[0]) for class_def in self.class_defs()]
+
+    def type_list(self, offset):
+        if offset == 0:
+            return []
+        size = self.u4(offset)
+        return [self.type_descriptor(index) for index in struct.unpack_from(f"<{size}H", self.data, offset + 4)]
+
+    def method_id(self, index):
+        return METHOD_ID.unpack_from(self.data, self.method_ids_off + index * METHOD_ID.size)
+
+    def method_signature(self, index):
+        """Return ``(name, descriptor)`` of a method, e.g. ``("equals", "(Ljava/lang/Object;)Z")``."""
+        class_idx, proto_idx, name_idx = self.method_id(index)
+        shorty_idx, return_type_idx, parameters_off = PROTO_ID.unpack_from(
+            self.data, self.proto_ids_off + proto_idx * PROTO_ID.size)
+        parameters = "".join(self.type_list(parameters_off))
+        return self.string(name_idx), f"({parameters}){self.type_descriptor(return_type_idx)}"
+
+    def class_methods(self, class_data_off):
+        """Yield ``(method_idx, access_flags, code_off)`` for every method of a class."""
+        if class_data_off == 0:
+            return
+        offset = class_data_off
+        static_fields, offset = read_uleb128(self.data, offset)
+        instance_fields, offset = read_uleb128(self.data, offset)
+        direct_methods, offset = read_uleb128(self.data, offset)
+        virtual_methods, offset = read_uleb128(self.data, offset)
+
+        for _ in range(2 * (static_fields + instance_fields)):
+            _, offset = read_uleb128(self.data, offset)
+
+        for count in (direct_methods, virtual_methods):
+            method_idx = 0
+            for _ in range(count):
+                diff, offset = read_uleb128(self.data, offset)
+                access_flags, offset = read_uleb128(self.data, offset)
+                code_off, offset = read_uleb128(self.data, offset)
+                method_idx += diff
+                yield method_idx, access_flags, code_off
+
+    def method_declaration(self, method_idx, access_flags):
+        """Render a method the way baksmali writes its ``.method`` line."""
+        name, descriptor = self.method_signature(method_idx)
+        flags = [text for flag, text in METHOD_ACCESS_FLAGS if access_flags & flag]
+        return " ".join([".method"] + flags + [name + descriptor]) + "\n"
+
+
+def class_file_to_descriptor(class_file):
+    return "L" + class_file[:-len(".smali")] + ";"
+
+
+def descriptor_to_class_file(descriptor):
+    return descriptor[1:-1] + ".smali"
+
+
+def build_class_index(jar_path, dex_names):
+    """Map every class descriptor in ``dex_names`` of ``jar_path`` to its dex entry."""
+    index = {}
+    with zipfile.ZipFile(jar_path) as jar:
+        for dex_name in dex_names:
+            for descriptor in DexFile(jar.read(dex_name)).class_descriptors():
+                index.setdefault(descriptor, dex_name)
+    return index
+
+
+def targets_by_dex(jar_path, dex_names, class_files):
+    """Group ``class_files`` by the dex entry of ``jar_path`` that defines them.
+
+    Dex entries without any of the classes are left out of the result.
+    """
+    index = build_class_index(jar_path, dex_names)
+    grouped = {}
+    for class_file in class_files:
+        dex_name = index.get(class_file_to_descriptor(class_file))
+        if dex_name is not None:
+            grouped.setdefault(dex_name, []).append(class_file)
+    skipped = [dex_name for dex_name in dex_names if dex_name not in grouped]
+    if skipped:
+        logging.info(f"No patch targets in {jar_path}: {', '.join(skipped)}; keeping them as-is")
+    return {dex_name: grouped[dex_name] for dex_name in dex_names if dex_name in grouped}
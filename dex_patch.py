@@ -0,0 +1,241 @@
+import hashlib
+import logging
+import re
+import struct
+import zlib
+from collections import Counter
+
+import tracing
+from dex_index import DexFile, class_file_to_descriptor
+from patch_engine import MethodBodyRule
+
+CODE_ITEM = struct.Struct("<4H2I")
+NOP = 0x0000
+
+# Instruction width in 16-bit code units, indexed by opcode
+INSTRUCTION_WIDTHS = (
+    [1, 1, 2, 3, 1, 2, 3, 1, 2, 3, 1, 1, 1, 1, 1, 1] +           # 0x00 - 0x0f
+    [1, 1, 1, 2, 3, 2, 2, 3, 5, 2, 2, 3, 2, 1, 1, 2] +           # 0x10 - 0x1f
+    [2, 1, 2, 2, 3, 3, 3, 1, 1, 2, 3, 3, 3, 2, 2, 2] +           # 0x20 - 0x2f
+    [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 1, 1] +           # 0x30 - 0x3f
+    [1, 1, 1, 1] + [2] * 14 + [2] * 14 + [2] * 14 +              # 0x40 - 0x6d
+    [3, 3, 3, 3, 3, 1, 3, 3, 3, 3, 3, 1, 1] +                    # 0x6e - 0x7a
+    [1] * 21 + [2] * 32 + [1] * 32 + [2] * 8 + [2] * 11 +        # 0x7b - 0xe2
+    [1] * 23 + [4, 4, 3, 3, 2, 2]                                 # 0xe3 - 0xff
+)
+INVOKE_CUSTOM = (0xfc, 0xfd)
+
+# Text a rule may require, and the opcodes that stand for it in bytecode
+REQUIRED_OPCODES = {'invoke-custom': INVOKE_CUSTOM}
+
+const4_pattern = re.compile(r'^const/4 ([vp])(\d+), (-?0x[0-9a-fA-F]+|-?\d+)$')
+return_pattern = re.compile(r'^(return|return-object) ([vp])(\d+)$')
+
+
+class UnsupportedRule(Exception):
+    pass
+
+
+def instructions(insns):
+    """Yield ``(address, opcode)`` for every instruction in a list of code units."""
+    address = 0
+    while address < len(insns):
+        unit = insns[address]
+        opcode = unit & 0xff
+        if opcode == 0 and unit == 0x0100:
+            width = 4 + insns[address + 1] * 2
+        elif opcode == 0 and unit == 0x0200:
+            width = 2 + insns[address + 1] * 4
+        elif opcode == 0 and unit == 0x0300:
+            element_width = insns[address + 1]
+            size = insns[address + 2] | (insns[address + 3] << 16)
+            width = 4 + (size * element_width + 1) // 2
+        else:
+            width = INSTRUCTION_WIDTHS[opcode]
+        yield address, opcode
+        address += width
+
+
+def compile_body(body):
+    """Translate smali body lines into ``(instructions, registers)``.
+
+    ``instructions`` is a list of ``(opcode, register_kind, register, literal)``
+    tuples; ``.registers`` and annotation blocks are metadata that the dex
+    already carries and are skipped.
+    """
+    compiled = []
+    registers = None
+    in_annotation = False
+    for line in body:
+        text = line.strip()
+        if in_annotation:
+            in_annotation = text != '.end annotation'
+            continue
+        if not text:
+            continue
+        if text.startswith('.annotation'):
+            in_annotation = True
+        elif text.startswith('.registers'):
+            registers = int(text.split()[1])
+        elif text == 'return-void':
+            compiled.append((0x0e, None, 0, 0))
+        elif const4_pattern.match(text):
+            kind, number, literal = const4_pattern.match(text).groups()
+            value = int(literal, 0)
+            if not -8 <= value <= 7:
+                raise UnsupportedRule(f"const/4 literal out of range: {text}")
+            compiled.append((0x12, kind, int(number), value))
+        elif return_pattern.match(text):
+            opcode, kind, number = return_pattern.match(text).groups()
+            compiled.append((0x0f if opcode == 'return' else 0x11, kind, int(number), 0))
+        else:
+            raise UnsupportedRule(f"No dex encoding for: {text}")
+    return compiled, registers
+
+
+def compile_rules(rules):
+    """Turn smali rules into ``[(name, requires_opcodes, matcher, {key: body})]`` for the dex backend.
+
+    Only whole-method body replacements can be applied without moving
+    bytecode around; anything else raises :class:`UnsupportedRule`.
+    """
+    compiled = []
+    for rule in rules:
+        if not isinstance(rule, MethodBodyRule):
+            raise UnsupportedRule(f"{rule.name} has no dex backend")
+        requires = None
+        if rule.requires is not None:
+            if rule.requires not in REQUIRED_OPCODES:
+                raise UnsupportedRule(f"{rule.name} requires {rule.requires!r}")
+            requires = REQUIRED_OPCODES[rule.requires]
+        bodies = {key: compile_body(body) for key, (pattern, body) in rule.methods.items()}
+        compiled.append((rule.name, requires, rule.matcher, bodies))
+    return compiled
+
+
+def supports(rules):
+    try:
+        compile_rules(rules)
+    except UnsupportedRule:
+        return False
+    return True
+
+
+def encode(compiled_body, registers_size, ins_size):
+    units = []
+    for opcode, kind, number, literal in compiled_body:
+        register = number + (registers_size - ins_size if kind == 'p' else 0)
+        if opcode == 0x12:
+            if register > 0xf:
+                raise UnsupportedRule(f"const/4 cannot address v{register}")
+            units.append(opcode | (register << 8) | ((literal & 0xf) << 12))
+        elif opcode == 0x0e:
+            units.append(opcode)
+        else:
+            units.append(opcode | (register << 8))
+    return units
+
+
+class DexPatcher:
+    """Apply method-body rules directly to a dex image.
+
+    The new body is written over the start of the existing ``insns`` and the
+    remainder is filled with ``nop``, so the code item keeps its size and
+    its try blocks and no other offset in the file moves.
+    """
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.dex = DexFile(self.data)
+        self._code_refs = None
+
+    def code_refs(self):
+        if self._code_refs is None:
+            self._code_refs = Counter(code_off for class_def in self.dex.class_defs()
+                                      for _, _, code_off in self.dex.class_methods(class_def[6]) if code_off)
+        return self._code_refs
+
+    def read_code(self, code_off):
+        registers_size, ins_size, outs_size, tries_size, debug_info_off, insns_size = \
+            CODE_ITEM.unpack_from(self.data, code_off)
+        insns = struct.unpack_from(f"<{insns_size}H", self.data, code_off + CODE_ITEM.size)
+        return registers_size, ins_size, outs_size, tries_size, insns
+
+    def class_uses(self, class_data_off, opcodes):
+        for _, _, code_off in self.dex.class_methods(class_data_off):
+            if code_off and any(opcode in opcodes for _, opcode in instructions(self.read_code(code_off)[4])):
+                return True
+        return False
+
+    def patch_class(self, descriptor, compiled_rules, stats):
+        class_def = next((class_def for class_def in self.dex.class_defs()
+                          if self.dex.type_descriptor(class_def[0]) == descriptor), None)
+        if class_def is None:
+            return False
+        class_data_off = class_def[6]
+
+        for name, requires, matcher, bodies in compiled_rules:
+            if requires is not None and not self.class_uses(class_data_off, requires):
+                logging.info(f"No {name} target opcodes found in class: {descriptor}. Skipping modification.")
+                continue
+            for method_idx, access_flags, code_off in self.dex.class_methods(class_data_off):
+                declaration = self.dex.method_declaration(method_idx, access_flags)
+                key = matcher.match(declaration)
+                if key is not None and code_off:
+                    body, registers = bodies[key]
+                    self.replace_code(code_off, body, registers, f"{descriptor}->{key}")
+                    logging.info(f"Modifying method body for {key}")
+                    stats[name] += 1
+        return True
+
+    def replace_code(self, code_off, body, registers, label):
+        if self.code_refs()[code_off] > 1:
+            raise UnsupportedRule(f"Code item of {label} is shared with other methods")
+        registers_size, ins_size, outs_size, tries_size, insns = self.read_code(code_off)
+        registers_size = max(registers_size, registers or 0)
+        units = encode(body, registers_size, ins_size)
+        if len(units) > len(insns):
+            raise UnsupportedRule(f"{label} is too short to hold its replacement body")
+
+        units += [NOP] * (len(insns) - len(units))
+        CODE_ITEM.pack_into(self.data, code_off, registers_size, ins_size, outs_size, tries_size, 0, len(insns))
+        struct.pack_into(f"<{len(units)}H", self.data, code_off + CODE_ITEM.size, *units)
+
+    def finish(self):
+        self.data[12:32] = hashlib.sha1(self.data[32:]).digest()
+        struct.pack_into("<I", self.data, 8, zlib.adler32(self.data[12:]))
+        return bytes(self.data)
+
+
+def patch_dex_data(data, class_rules, label):
+    """Patch the dex image ``data`` with ``{class_file: [rules]}``.
+
+    Return the patched image (``None`` if no rule matched) and the per-rule
+    hit counts. ``label`` names the dex in logs and traces.
+    """
+    with tracing.span(label, "file", rules=sorted({rule.name for rules in class_rules.values() for rule in rules})) \
+            as counters:
+        patcher = DexPatcher(data)
+        counters["bytes_read"] += len(patcher.data)
+
+        stats = Counter()
+        for class_file, rules in class_rules.items():
+            if not patcher.patch_class(class_file_to_descriptor(class_file), compile_rules(rules), stats):
+                logging.warning(f"Class not found in {label}: {class_file}")
+
+        patched = patcher.finish() if stats else None
+        counters.update(bytes_written=len(patched or b""), rules_matched=sum(stats.values()),
+                        **{f"rule:{name}": n for name, n in stats.items()})
+    counts = ", ".join(f"{name}={count}" for name, count in sorted(stats.items()))
+    logging.info(f"Patched {label} in place ({counts or 'no matches'})")
+    return patched, stats
+
+
+def patch_dex_file(dex_path, class_rules):
+    """Patch ``dex_path`` in place with ``{class_file: [rules]}``; return per-rule hit counts."""
+    with open(dex_path, 'rb') as file:
+        patched, stats = patch_dex_data(file.read(), class_rules, dex_path)
+    if patched is not None:
+        with open(dex_path, 'wb') as file:
+            file.write(patched)
+    return stats
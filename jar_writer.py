@@ -0,0 +1,212 @@
+import argparse
+import io
+import logging
+import os
+import struct
+import zipfile
+import zlib
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+CENTRAL_HEADER = struct.Struct("<4s6H3I5H2I")
+END_RECORD = struct.Struct("<4s4H2IH")
+LOCAL_SIGNATURE = b"PK\x03\x04"
+CENTRAL_SIGNATURE = b"PK\x01\x02"
+END_SIGNATURE = b"PK\x05\x06"
+
+DATA_DESCRIPTOR_FLAG = 0x08
+ALIGNMENT_EXTRA_ID = 0xd935
+ALIGNMENT = 4
+PAGE_ALIGNMENT = 4096
+CHUNK_SIZE = 1 << 20
+
+
+def dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+def strip_alignment(extra):
+    """Drop an alignment record left by an earlier zipalign, keeping the other extra fields."""
+    fields = b""
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from("<HH", extra, offset)
+        if header_id != ALIGNMENT_EXTRA_ID:
+            fields += extra[offset:offset + 4 + size]
+        offset += 4 + size
+    return fields
+
+
+def aligned_extra(extra, data_offset, alignment):
+    """Append an alignment record to ``extra`` so that data starting at ``data_offset`` lands on ``alignment``."""
+    padding = -(data_offset + len(extra) + 6) % alignment
+    return extra + struct.pack("<HHH", ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + b"\0" * padding
+
+
+def entry_alignment(info, page_align):
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    if page_align and info.filename.endswith(".so"):
+        return PAGE_ALIGNMENT
+    return ALIGNMENT
+
+
+class JarWriter:
+    """Writes a zip entry by entry, aligning stored entries the way ``zipalign -p 4`` does."""
+
+    def __init__(self, output, page_align=True):
+        self.output = output
+        self.page_align = page_align
+        self.central = []
+
+    def _local_header(self, info, flags, crc, compress_size, file_size):
+        name = info.filename.encode("utf-8" if info.flag_bits & 0x800 else "cp437")
+        offset = self.output.tell()
+        extra = strip_alignment(info.extra)
+        alignment = entry_alignment(info, self.page_align)
+        if alignment:
+            extra = aligned_extra(extra, offset + LOCAL_HEADER.size + len(name), alignment)
+        dos_time, dos_date = dos_date_time(info.date_time)
+        self.output.write(LOCAL_HEADER.pack(LOCAL_SIGNATURE, info.extract_version, flags, info.compress_type,
+                                            dos_time, dos_date, crc, compress_size, file_size,
+                                            len(name), len(extra)))
+        self.output.write(name)
+        self.output.write(extra)
+        self.central.append((info, name, flags, offset))
+        return offset
+
+    def copy_entry(self, source, info):
+        """Copy ``info``'s compressed bytes from the open zip file ``source`` without recompressing."""
+        source.seek(info.header_offset)
+        header = LOCAL_HEADER.unpack(source.read(LOCAL_HEADER.size))
+        if header[0] != LOCAL_SIGNATURE:
+            raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+        source.seek(header[9] + header[10], os.SEEK_CUR)
+
+        flags = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+        self._local_header(info, flags, info.CRC, info.compress_size, info.file_size)
+        remaining = info.compress_size
+        while remaining:
+            chunk = source.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+            self.output.write(chunk)
+            remaining -= len(chunk)
+
+    def write_entry(self, info, stream):
+        """Write new contents for ``info`` from the binary ``stream``, keeping its compression method."""
+        flags = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+        offset = self._local_header(info, flags, 0, 0, 0)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15) if info.compress_type == zipfile.ZIP_DEFLATED else None
+        if compressor is None and info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError(f"Unsupported compression method {info.compress_type} for {info.filename}")
+
+        crc = file_size = compress_size = 0
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            data = compressor.compress(chunk) if compressor else chunk
+            self.output.write(data)
+            compress_size += len(data)
+        if compressor:
+            data = compressor.flush()
+            self.output.write(data)
+            compress_size += len(data)
+
+        end = self.output.tell()
+        self.output.seek(offset + 14)
+        self.output.write(struct.pack("<3I", crc, compress_size, file_size))
+        self.output.seek(end)
+        info.CRC, info.compress_size, info.file_size = crc, compress_size, file_size
+
+    def finish(self, comment=b""):
+        start = self.output.tell()
+        for info, name, flags, offset in self.central:
+            dos_time, dos_date = dos_date_time(info.date_time)
+            comment_bytes = info.comment
+            self.output.write(CENTRAL_HEADER.pack(
+                CENTRAL_SIGNATURE, (info.create_system << 8) | info.create_version, info.extract_version, flags,
+                info.compress_type, dos_time, dos_date, info.CRC, info.compress_size, info.file_size,
+                len(name), len(info.extra), len(comment_bytes), 0, info.internal_attr, info.external_attr, offset))
+            self.output.write(name)
+            self.output.write(info.extra)
+            self.output.write(comment_bytes)
+        size = self.output.tell() - start
+        if len(self.central) > 0xffff or start > 0xffffffff:
+            raise ValueError("Jar needs zip64, which is not supported")
+        self.output.write(END_RECORD.pack(END_SIGNATURE, 0, 0, len(self.central), len(self.central),
+                                          size, start, len(comment)))
+        self.output.write(comment)
+
+
+def write_jar(source_jar, output_jar, replacements=None, page_align=True):
+    """Write ``source_jar`` to ``output_jar`` aligned, with the entries in ``replacements`` swapped in.
+
+    ``replacements`` maps entry names to file paths (or bytes). Every other
+    entry is copied byte for byte in its compressed form, so nothing is
+    recompressed; replaced entries keep their original compression method
+    and timestamp.
+    """
+    replacements = dict(replacements or {})
+    temp_path = output_jar + ".tmp"
+    try:
+        with zipfile.ZipFile(source_jar) as jar, open(source_jar, 'rb') as source, open(temp_path, 'wb') as output:
+            if any(info.file_size > 0xffffffff or info.compress_size > 0xffffffff for info in jar.infolist()):
+                raise ValueError(f"{source_jar} needs zip64, which is not supported")
+            writer = JarWriter(output, page_align)
+            for info in jar.infolist():
+                replacement = replacements.pop(info.filename, None)
+                if replacement is None:
+                    writer.copy_entry(source, info)
+                elif isinstance(replacement, (bytes, bytearray)):
+                    writer.write_entry(info, io.BytesIO(replacement))
+                else:
+                    with open(replacement, 'rb') as stream:
+                        writer.write_entry(info, stream)
+            if replacements:
+                raise KeyError(f"Entries not in {source_jar}: {', '.join(sorted(replacements))}")
+            writer.finish(jar.comment)
+        os.replace(temp_path, output_jar)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def changed_dex_entries(source_jar, dex_dir):
+    """Map the ``classes*.dex`` entries whose copy in ``dex_dir`` differs from the jar to that copy."""
+    changed = {}
+    with zipfile.ZipFile(source_jar) as jar:
+        for info in jar.infolist():
+            if not (info.filename.startswith("classes") and info.filename.endswith(".dex")):
+                continue
+            path = os.path.join(dex_dir, info.filename)
+            if not os.path.exists(path):
+                continue
+            if os.path.getsize(path) != info.file_size or file_crc32(path) != info.CRC:
+                changed[info.filename] = path
+    return changed
+
+
+def file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild an aligned jar with the reassembled dex files swapped in")
+    parser.add_argument("source_jar", help="the stock jar")
+    parser.add_argument("dex_dir", help="directory holding the (re)assembled classes*.dex files")
+    parser.add_argument("output_jar", help="where to write the aligned jar")
+    parser.add_argument("--no-page-align", action="store_true", help="don't align stored .so files to 4 KiB")
+    args = parser.parse_args()
+
+    replacements = changed_dex_entries(args.source_jar, args.dex_dir)
+    if not replacements:
+        logging.info(f"No dex changes for {args.source_jar}; copying it aligned")
+    write_jar(args.source_jar, args.output_jar, replacements, page_align=not args.no_page_align)
+    logging.info(f"Wrote {args.output_jar} ({', '.join(sorted(replacements)) or 'no replaced entries'})")
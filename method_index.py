@@ -0,0 +1,59 @@
+import array
+import re
+
+# A .method or .end method directive at the start of a line
+DIRECTIVE = re.compile(rb'^[ \t]*\.(method\b|end method[ \t]*\r?$)', re.M)
+
+
+class MethodIndex:
+    """Byte offsets of the methods of a smali file, found in one scan.
+
+    ``starts[i]`` is where the ``.method`` line of method ``i`` begins and
+    ``ends[i]`` where its ``.end method`` line begins. Both are
+    ``array('q')``, so the index of a class with thousands of methods is a
+    few kilobytes. A method without ``.end method`` is left out.
+
+    The index lives only as long as one ``patch_file`` call: after a splice
+    it is shifted with ``spliced`` for the next pass instead of rescanning
+    the rewritten bytes.
+    """
+
+    def __init__(self, starts=(), ends=()):
+        self.starts = array.array('q', starts)
+        self.ends = array.array('q', ends)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def build(cls, data):
+        index = cls()
+        start = None
+        for match in DIRECTIVE.finditer(data):
+            if match.group(1) == b'method':
+                start = match.start()
+            elif start is not None:
+                index.starts.append(start)
+                index.ends.append(match.start())
+                start = None
+        return index
+
+    def spliced(self, edits):
+        """The index after replacing each ``(start, end, text)`` range of ``edits``, sorted, inside method bodies."""
+        index = MethodIndex()
+        shift = 0
+        pending = iter(edits)
+        edit = next(pending, None)
+        for start, end in self:
+            while edit is not None and edit[1] <= start:
+                shift += len(edit[2]) - (edit[1] - edit[0])
+                edit = next(pending, None)
+            index.starts.append(start + shift)
+            while edit is not None and edit[1] <= end:
+                shift += len(edit[2]) - (edit[1] - edit[0])
+                edit = next(pending, None)
+            index.ends.append(end + shift)
+        return index
@@ -1,48 +1,36 @@
-import os
-import re
+import argparse
 import logging
 
+import tracing
+from patch_engine import smali_directories, write_manifest
+from rule_pack import load_pack
+from snapshot import Snapshot
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def replace_string_in_file(file_path, search_string, replace_string):
-    logging.info(f"Replacing string in file: {file_path}")
-    with open(file_path, 'r') as file:
-        content = file.read()
-
-    modified_content = content.replace(search_string, replace_string)
-
-    with open(file_path, 'w') as file:
-        file.write(modified_content)
-    logging.info(f"Completed string replacement in file: {file_path}")
-
-
-def modify_smali_files(directories):
-    classes_to_modify = [
-        'android/inputmethodservice/InputMethodServiceInjector.smali',
-        'android/view/DisplayInfoInjector$2.smali',
-        'miui/util/HapticFeedbackUtil.smali'
-    ]
+def build_engine():
+    return load_pack("miui_framework")
 
-    search_string = "com.baidu.input_mi"
-    replace_string = "com.google.android.inputmethod.latin"
 
-    for directory in directories:
-        for class_file in classes_to_modify:
-            file_path = os.path.join(directory, class_file)
-            if os.path.exists(file_path):
-                logging.info(f"Found file: {file_path}")
-                if class_file in [
-                    'android/inputmethodservice/InputMethodServiceInjector.smali',
-                    'android/view/DisplayInfoInjector$2.smali',
-                    'miui/util/HapticFeedbackUtil.smali'
-                ]:
-                    replace_string_in_file(file_path, search_string, replace_string)
-            else:
-                logging.warning(f"File not found: {file_path}")
+def modify_smali_files(directories, jobs=1, changed=None, snapshot=None):
+    return build_engine().apply(directories, jobs=jobs, changed=changed, snapshot=snapshot)
 
 
 if __name__ == "__main__":
-    directories = ["miui_framework_classes"]
-    modify_smali_files(directories)
+    parser = argparse.ArgumentParser(description="Patch decompiled miui-framework.jar smali")
+    parser.add_argument("--manifest", help="append the paths of changed files to this file")
+    parser.add_argument("--snapshot", help="keep the originals of rewritten files in this directory")
+    tracing.add_arguments(parser)
+    args = parser.parse_args()
+    tracing.configure(args)
+
+    directories = smali_directories("miui_framework_classes")
+    changed = []
+    snapshot = Snapshot(args.snapshot) if args.snapshot else None
+    with tracing.span("miui_framework_patch"):
+        modify_smali_files(directories, changed=changed, snapshot=snapshot)
+    if args.manifest:
+        write_manifest(args.manifest, changed)
+    tracing.write_outputs(args)
@@ -0,0 +1,775 @@
+import io
+import os
+import re
+import logging
+import mmap
+import multiprocessing
+import shutil
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
+
+import tracing
+from dex_index import class_file_to_descriptor
+from method_index import MethodIndex
+
+METHOD_PREFIX = r'\.method'
+# Buffers passed to one os.writev call
+IOV_MAX = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 16
+REGEX_SPECIAL = set('.^$*+?{}[]|()')
+
+
+def literal_needle(pattern):
+    """Return the longest literal text every match of ``pattern`` must contain, as bytes.
+
+    Only text outside groups and classes counts; patterns with a top-level
+    ``|`` or no literal run of at least 3 characters give ``None``.
+    """
+    if re.compile(pattern).flags & re.IGNORECASE:
+        return None
+    runs = [""]
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            escaped = pattern[i + 1]
+            i += 2
+            if depth == 0 and not escaped.isalnum():
+                runs[-1] += escaped
+            else:
+                runs.append("")
+            continue
+        i += 1
+        if char == '[':
+            i = pattern.index(']', i + 1) + 1
+            runs.append("")
+        elif char == '(':
+            depth += 1
+            runs.append("")
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return None
+        elif char in '*?{' and depth == 0:
+            runs[-1] = runs[-1][:-1]
+            runs.append("")
+        elif char in REGEX_SPECIAL or depth:
+            runs.append("")
+        else:
+            runs[-1] += char
+    needle = max(runs, key=len)
+    return needle.encode() if len(needle) >= 3 else None
+
+
+def needles_for(patterns):
+    """Needles of a rule that matches any of ``patterns``, or ``None`` if one of them has no literal."""
+    needles = [literal_needle(pattern) for pattern in patterns]
+    return None if None in needles else tuple(dict.fromkeys(needles))
+
+
+class Rule:
+    """A streaming transform over a file's lines.
+
+    ``needles`` are literal byte strings of which at least one must occur in
+    a file for the rule to match anything; ``None`` means the rule can't
+    tell. ``prefilter`` checks them against the raw (mmapped) file before
+    any line is decoded. ``apply`` maps an iterator of lines to the patched
+    lines, counting the sites it patches in ``stats`` and the sites it finds
+    already patched in ``stats.already``, which it leaves alone so that
+    running a rule twice changes nothing.
+
+    A rule with ``splicing`` set also offers ``splices``, which patches the
+    raw bytes instead of a line stream, given the file's ``MethodIndex``.
+    """
+
+    name = "rule"
+    needles = None
+    splicing = False
+
+    def prefilter(self, data, file_path):
+        return self.needles is None or any(data.find(needle) >= 0 for needle in self.needles)
+
+    def apply(self, lines, stats):
+        raise NotImplementedError
+
+    def splices(self, data, methods, stats):
+        """Return the edits of ``data`` as sorted, disjoint ``(start, end, text)`` byte ranges."""
+        raise NotImplementedError
+
+
+class SiteStats(Counter):
+    """Sites patched per rule name, with the sites found already patched in ``already``."""
+
+    def __init__(self, applied=(), already=()):
+        super().__init__(applied)
+        self.already = Counter(already)
+
+    def __reduce__(self):
+        return self.__class__, (dict(self), dict(self.already))
+
+
+class MethodMatcher:
+    """Find which of several method-header patterns matches a line, in one regex search.
+
+    The patterns are joined into a single alternation with one named group
+    per key, tried in the order given, so the first matching key wins just
+    as with checking the patterns one by one. When every pattern starts
+    with ``\\.method`` the search is only run on lines containing
+    ``.method``.
+    """
+
+    def __init__(self, patterns):
+        self.keys = {}
+        alternatives = []
+        for i, (key, pattern) in enumerate(patterns.items()):
+            self.keys[f"_m{i}"] = key
+            alternatives.append(f"(?P<_m{i}>{pattern})")
+        self.regex = re.compile("|".join(alternatives))
+        if self.regex.groups != len(alternatives):
+            # Patterns with their own groups would shift each other's backreferences
+            self.regex = None
+            self.patterns = {key: re.compile(pattern) for key, pattern in patterns.items()}
+        self.gate = '.method' if all(pattern.startswith(METHOD_PREFIX) for pattern in patterns.values()) else None
+
+    def match(self, line):
+        if self.gate is not None and self.gate not in line:
+            return None
+        if self.regex is None:
+            return next((key for key, pattern in self.patterns.items() if pattern.search(line)), None)
+        match = self.regex.search(line)
+        return None if match is None else self.keys[match.lastgroup]
+
+
+class MethodBodyRule(Rule):
+    """Replace the body of every method whose declaration matches one of ``methods``.
+
+    ``methods`` maps a name to ``(pattern, body)``. With ``keep_registers`` the
+    method's original ``.registers`` line is kept in front of the new body.
+    A method whose body already is the replacement is left as it is and
+    counted as already patched. ``requires`` leaves the other methods alone
+    unless that text appears in the file; it is checked after the
+    already-patched bodies are counted, since patching may remove the text.
+
+    When every pattern starts with ``\\.method`` the rule splices: only the
+    declaration lines found through the file's ``MethodIndex`` are decoded
+    and matched, and each replaced body becomes one byte-range edit.
+    """
+
+    def __init__(self, methods, keep_registers=True, requires=None, name="method_body"):
+        self.name = name
+        self.methods = {key: (re.compile(pattern), body) for key, (pattern, body) in methods.items()}
+        self.matcher = MethodMatcher({key: pattern for key, (pattern, body) in methods.items()})
+        self.keep_registers = keep_registers
+        self.requires = requires
+        self.needles = needles_for(pattern for pattern, body in methods.values())
+        self.splicing = self.matcher.gate is not None
+
+    def prefilter(self, data, file_path):
+        if self.requires is not None and data.find(self.requires.encode()) < 0 and not any(
+                data.find("".join(body).encode()) >= 0 for pattern, body in self.methods.values()):
+            # Without the required text only already-patched bodies are counted; there are none
+            logging.info(f"No {self.requires} found in file: {file_path}. Skipping modification.")
+            return False
+        return super().prefilter(data, file_path)
+
+    def replacement(self, method_type, original):
+        registers_line = next((line for line in reversed(original) if line.strip().startswith('.registers')), "")
+        body = [registers_line] if self.keep_registers and registers_line else []
+        return body + self.methods[method_type][1]
+
+    def splices(self, data, methods, stats):
+        required = self.requires is None or data.find(self.requires.encode()) >= 0
+        edits = []
+        for start, end in methods:
+            body_start = data.find(b'\n', start, end) + 1
+            if not body_start:
+                continue
+            method_type = self.matcher.match(data[start:body_start].decode())
+            if method_type is None:
+                continue
+            original = list(io.StringIO(data[body_start:end].decode()))
+            body = self.replacement(method_type, original)
+            if original == body:
+                logging.info(f"Method body for {method_type} is already patched")
+                stats.already[self.name] += 1
+                continue
+            if not required:
+                continue
+            logging.info(f"Modifying method body for {method_type}")
+            stats[self.name] += 1
+            edits.append((body_start, end, "".join(body).encode()))
+        return edits
+
+    def apply(self, lines, stats):
+        required = True
+        if self.requires is not None:
+            lines = list(lines)
+            required = any(self.requires in line for line in lines)
+        method_type = None
+        method_start_line = ""
+        original = []
+
+        for line in lines:
+            if method_type is not None:
+                if line.strip() == '.end method':
+                    body = self.replacement(method_type, original)
+                    yield method_start_line
+                    if original == body:
+                        logging.info(f"Method body for {method_type} is already patched")
+                        stats.already[self.name] += 1
+                    elif not required:
+                        body = original
+                    else:
+                        logging.info(f"Modifying method body for {method_type}")
+                        stats[self.name] += 1
+                    yield from body
+                    yield line
+                    method_type = None
+                    original = []
+                    continue
+                original.append(line)
+                continue
+
+            method_type = self.matcher.match(line)
+            if method_type is not None:
+                method_start_line = line
+            else:
+                yield line
+
+
+class InsertBeforeRule(Rule):
+    """Insert ``add_line`` above every line matching ``pattern`` that doesn't already follow it."""
+
+    def __init__(self, pattern, add_line, name="insert_before"):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.needles = needles_for([pattern])
+        self.add_line = add_line
+
+    def apply(self, lines, stats):
+        previous = None
+        for line in lines:
+            if self.pattern.search(line):
+                if previous is not None and previous.strip() == self.add_line.strip():
+                    logging.info(f"Found target line. Line above it is already added.")
+                    stats.already[self.name] += 1
+                else:
+                    logging.info(f"Found target line. Adding line above it.")
+                    stats[self.name] += 1
+                    yield self.add_line
+            yield line
+            previous = line
+
+
+class InsertAfterMoveResultRule(Rule):
+    """Pin the register filled by the ``move-result`` following ``pattern`` to ``value``.
+
+    Blank lines between the invoke and its ``move-result`` are skipped; with
+    ``replace`` the ``move-result`` itself is dropped instead of being kept.
+    A site where the ``const/4`` is already in place is left as it is.
+    """
+
+    move_result_pattern = re.compile(r'\s*move-result\s+(v\d+)')
+
+    def __init__(self, pattern, value, lookahead=None, replace=False, name="move_result"):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.needles = needles_for([pattern])
+        self.value = value
+        self.lookahead = lookahead
+        self.replace = replace
+        self.const_pattern = re.compile(rf'\s*const/4 [vp]\d+, {re.escape(value)}\s*$')
+
+    def apply(self, lines, stats):
+        pending = None
+        move_result = None
+        for line in lines:
+            if move_result is not None:
+                # A kept move-result: the const/4 goes right after it unless it is already there
+                move_result_line, register = move_result
+                move_result = None
+                const_line = f"    const/4 {register}, {self.value}\n"
+                if line.strip() == const_line.strip():
+                    logging.info(f"{register} is already set to {self.value} after {move_result_line.strip()}")
+                    stats.already[self.name] += 1
+                    yield line
+                    continue
+                logging.info(f"Setting {register} to {self.value} after {move_result_line.strip()}")
+                stats[self.name] += 1
+                yield const_line
+
+            if pending is not None:
+                match = self.move_result_pattern.match(line)
+                if match:
+                    register = match.group(1)
+                    yield from pending
+                    pending = None
+                    if self.replace:
+                        logging.info(f"Setting {register} to {self.value} after {line.strip()}")
+                        stats[self.name] += 1
+                        yield f"    const/4 {register}, {self.value}\n"
+                    else:
+                        yield line
+                        move_result = (line, register)
+                    continue
+                if self.replace and self.const_pattern.match(line):
+                    logging.info(f"move-result is already replaced by {line.strip()}")
+                    stats.already[self.name] += 1
+                    yield from pending
+                    pending = None
+                    yield line
+                    continue
+                if (self.lookahead is None and line.strip() == "") or \
+                        (self.lookahead is not None and len(pending) < self.lookahead - 1):
+                    pending.append(line)
+                    continue
+                yield from pending
+                pending = None
+
+            yield line
+            if self.pattern.search(line):
+                pending = []
+
+        if move_result is not None:
+            move_result_line, register = move_result
+            logging.info(f"Setting {register} to {self.value} after {move_result_line.strip()}")
+            stats[self.name] += 1
+            yield f"    const/4 {register}, {self.value}\n"
+        if pending:
+            yield from pending
+
+
+class ReplaceInMethodRule(Rule):
+    """Replace ``search`` with ``replace`` inside methods matching ``method_pattern``.
+
+    A matching method without ``search`` but with ``replace`` counts as
+    already patched.
+    """
+
+    def __init__(self, method_pattern, search, replace, name="replace_in_method"):
+        self.name = name
+        self.method_pattern = re.compile(method_pattern)
+        self.search = search
+        self.needles = (search.encode(), replace.encode())
+        self.replace = replace
+
+    def apply(self, lines, stats):
+        in_method = False
+        applied = replaced = False
+        for line in lines:
+            if in_method and line.strip() == '.end method':
+                in_method = False
+                if replaced and not applied:
+                    logging.info(f"Target line is already modified.")
+                    stats.already[self.name] += 1
+            if self.method_pattern.search(line):
+                in_method = True
+                applied = replaced = False
+            if in_method and self.search in line:
+                logging.info(f"Found target line. Modifying it.")
+                stats[self.name] += 1
+                applied = True
+                line = line.replace(self.search, self.replace)
+            elif in_method and self.replace in line:
+                replaced = True
+            yield line
+
+
+class InsertAfterRule(Rule):
+    """Insert ``add_line_template`` after every line matching ``pattern``.
+
+    The template is formatted with the pattern's first group as ``vX``. A
+    match already followed by the formatted line is left as it is.
+    """
+
+    def __init__(self, pattern, add_line_template, name="insert_after"):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.needles = needles_for([pattern])
+        self.add_line_template = add_line_template
+
+    def apply(self, lines, stats):
+        add_line = None
+        for line in lines:
+            if add_line is not None:
+                if line.strip() == add_line.strip():
+                    logging.info(f"Line after pattern is already added: {add_line.strip()}")
+                    stats.already[self.name] += 1
+                else:
+                    stats[self.name] += 1
+                    yield add_line
+                add_line = None
+            yield line
+            match = self.pattern.search(line)
+            if match:
+                vX = match.group(1)
+                logging.info(f"Found pattern with variable {vX}")
+                add_line = self.add_line_template.format(vX=vX) + '\n'
+        if add_line is not None:
+            stats[self.name] += 1
+            yield add_line
+
+
+class ReplaceStringRule(Rule):
+    """Replace every ``search_string``; occurrences of ``replace_string`` count as already patched."""
+
+    def __init__(self, search_string, replace_string, name="replace_string"):
+        self.name = name
+        self.search_string = search_string
+        self.replace_string = replace_string
+        self.needles = (search_string.encode(), replace_string.encode())
+
+    def apply(self, lines, stats):
+        for line in lines:
+            if self.search_string in line:
+                stats[self.name] += line.count(self.search_string)
+                line = line.replace(self.search_string, self.replace_string)
+            elif self.replace_string in line:
+                stats.already[self.name] += line.count(self.replace_string)
+            yield line
+
+
+class RemoveBranchRule(Rule):
+    """Drop the null check on the result of a call matching ``pattern``, and the label it jumps to.
+
+    The check is the ``if-eqz`` on the register filled by the call's
+    ``move-result-object``; blank lines and directives in between are
+    skipped. A call whose result is no longer checked counts as already
+    patched.
+    """
+
+    move_result_pattern = re.compile(r'\s*move-result-object\s+(v\d+)')
+    if_eqz_pattern = re.compile(r'\s*if-eqz (v\d+), (:cond_\w+)')
+
+    def __init__(self, pattern, name="remove_branch"):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.needles = needles_for([pattern])
+
+    def apply(self, lines, stats):
+        state = None
+        register = label = None
+        for line in lines:
+            if state in ("move_result", "if_eqz") and (not line.strip() or line.strip().startswith('.')):
+                yield line
+                continue
+            if state == "move_result":
+                match = self.move_result_pattern.match(line)
+                state, register = ("if_eqz", match.group(1)) if match else (None, None)
+                if match:
+                    yield line
+                    continue
+            elif state == "if_eqz":
+                match = self.if_eqz_pattern.match(line)
+                if match and match.group(1) == register:
+                    logging.info(f"Removing line: {line.strip()}")
+                    stats[self.name] += 1
+                    state, label = "label", match.group(2)
+                    continue
+                logging.info(f"Result in {register} is no longer checked; already patched")
+                stats.already[self.name] += 1
+                state = None
+            elif state == "label" and line.strip() == label:
+                logging.info(f"Removing line: {line.strip()}")
+                state = None
+                continue
+            if state is None and self.pattern.search(line):
+                state = "move_result"
+            yield line
+
+
+class _RecordCollector(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def smali_directories(prefix, root="."):
+    """The ``prefix``, ``prefix2``, ``prefix3``, ... directories under ``root``, in dex order."""
+    pattern = re.compile(re.escape(prefix) + r'(\d*)$')
+    matches = [pattern.match(name) for name in os.listdir(root) if os.path.isdir(os.path.join(root, name))]
+    return [os.path.normpath(os.path.join(root, match.group(0)))
+            for match in sorted(filter(None, matches), key=lambda match: int(match.group(1) or 1))]
+
+
+class ClassIndex:
+    """Class descriptor -> smali file across decompiled trees, built by one scan.
+
+    With ``packages`` only those package directories are listed in each
+    tree; otherwise the trees are walked in full. A class found in more
+    than one tree resolves to the first.
+    """
+
+    def __init__(self, directories, packages=None):
+        self.files = {}
+        for directory in directories:
+            if packages is None:
+                for root, dirs, files in os.walk(directory):
+                    dirs.sort()
+                    package = os.path.relpath(root, directory).replace(os.sep, '/')
+                    self._add(directory, "" if package == "." else package, files)
+                continue
+            for package in sorted(packages):
+                try:
+                    files = os.listdir(os.path.join(directory, package))
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                self._add(directory, package, files)
+
+    def _add(self, directory, package, files):
+        for file in sorted(files):
+            if file.endswith(".smali"):
+                class_file = f"{package}/{file}" if package else file
+                self.files.setdefault(class_file_to_descriptor(class_file), os.path.join(directory, class_file))
+
+    def find(self, class_file):
+        return self.files.get(class_file_to_descriptor(class_file))
+
+
+class PatchEngine:
+    """Rules registered per class file, applied to each file in a single pass."""
+
+    def __init__(self):
+        self.rules = {}
+        self.optional = set()
+
+    def register(self, class_file, *rules, optional=False):
+        self.rules.setdefault(class_file, []).extend(rules)
+        if optional:
+            self.optional.add(class_file)
+
+    def subset(self, class_files):
+        """A new engine with the rules of only those registered classes that are in ``class_files``."""
+        engine = PatchEngine()
+        for class_file, rules in self.rules.items():
+            if class_file in class_files:
+                engine.register(class_file, *rules, optional=class_file in self.optional)
+        return engine
+
+    def tasks(self, directories, snapshot=None):
+        index = ClassIndex(directories, {os.path.dirname(class_file) for class_file in self.rules})
+        for class_file, rules in self.rules.items():
+            file_path = index.find(class_file)
+            if file_path is not None:
+                yield file_path, rules, class_file in self.optional, snapshot
+            elif class_file not in self.optional:
+                logging.warning(f"Class not found in {', '.join(directories)}: {class_file}")
+
+    def apply(self, directories, jobs=1, changed=None, snapshot=None):
+        """Patch every registered class under ``directories``.
+
+        With ``jobs`` > 1 the files are patched in a process pool; log records
+        are replayed in task order so the output matches a serial run. The
+        paths of files that carry patches, whether rewritten now or already
+        patched by an earlier run, are appended to ``changed``; the originals
+        of rewritten files are saved in ``snapshot`` (a ``snapshot.Snapshot``).
+        Rules that find no site in a required class are logged as missing.
+        """
+        tasks = list(self.tasks(directories, snapshot))
+        summary = SiteStats()
+        patched = already = 0
+        missing = []
+        results = []
+
+        if jobs > 1 and len(tasks) > 1:
+            # forkserver keeps this safe when called from the orchestrator's threads
+            context = multiprocessing.get_context("forkserver")
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+                for stats, records, spans in executor.map(_apply_task_captured, tasks,
+                                                          repeat(tracing.tracer.enabled)):
+                    for record in records:
+                        logger = logging.getLogger(record.name)
+                        if logger.isEnabledFor(record.levelno):
+                            logger.handle(record)
+                    tracing.tracer.merge(spans)
+                    results.append(stats)
+        else:
+            results = [_apply_task(task) for task in tasks]
+
+        for (file_path, rules, optional, _), stats in zip(tasks, results):
+            summary.update(stats)
+            summary.already.update(stats.already)
+            if stats:
+                patched += 1
+            elif stats.already:
+                already += 1
+            if changed is not None and (stats or stats.already):
+                changed.append(file_path)
+            if not optional:
+                missing += [f"{rule.name} in {file_path}" for rule in dict.fromkeys(rules)
+                            if not stats[rule.name] and not stats.already[rule.name]]
+
+        counts = ", ".join(f"{name}={count}" for name, count in sorted(summary.items()))
+        logging.info(f"Patched {patched} files ({counts or 'no matches'})")
+        if summary.already:
+            counts = ", ".join(f"{name}={count}" for name, count in sorted(summary.already.items()))
+            logging.info(f"Already patched: {counts} ({already} files needed no changes)")
+        for site in missing:
+            logging.warning(f"No site found for {site}")
+        return summary
+
+
+def write_manifest(manifest_path, changed):
+    """Append the ``changed`` file paths to ``manifest_path``, one per line.
+
+    The recompile steps reassemble only the smali directories that appear
+    in the manifest and keep the original dex for the rest.
+    """
+    with open(manifest_path, 'a') as manifest:
+        for file_path in changed:
+            manifest.write(os.path.normpath(file_path).replace(os.sep, '/') + '\n')
+    logging.info(f"Recorded {len(changed)} changed files in {manifest_path}")
+
+
+def _apply_task(task):
+    file_path, rules, optional, snapshot = task
+    if not optional:
+        logging.info(f"Found file: {file_path}")
+    return patch_file(file_path, rules, snapshot)
+
+
+def _apply_task_captured(task, trace=False):
+    root = logging.getLogger()
+    collector = _RecordCollector()
+    handlers = root.handlers
+    root.handlers = [collector]
+    tracing.tracer.enabled = trace
+    try:
+        stats = _apply_task(task)
+    finally:
+        root.handlers = handlers
+    return stats, collector.records, tracing.tracer.drain()
+
+
+def counted(lines, counters):
+    for line in lines:
+        counters["lines_scanned"] += 1
+        yield line
+
+
+@contextmanager
+def mapped(file_path):
+    """The bytes of ``file_path``, mmapped; an empty file, which can't be mapped, gives ``b""``."""
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def prefilter(file_path, rules):
+    """Return the rules whose needles occur in ``file_path``, searching the mmapped bytes."""
+    with mapped(file_path) as data:
+        return [rule for rule in rules if rule.prefilter(data, file_path)]
+
+
+def stages(rules):
+    """Split ``rules``, in order, into the passes over a file: each splicing rule alone, other rules in runs."""
+    groups = []
+    for rule in rules:
+        if rule.splicing or not groups or groups[-1][0].splicing:
+            groups.append([rule])
+        else:
+            groups[-1].append(rule)
+    return groups
+
+
+def write_buffers(fd, buffers):
+    """Write every buffer to ``fd`` in order with ``os.writev``, resuming after partial writes."""
+    buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    while buffers:
+        written = os.writev(fd, buffers[:IOV_MAX])
+        while written:
+            if written < len(buffers[0]):
+                buffers[0] = buffers[0][written:]
+                break
+            written -= len(buffers.pop(0))
+
+
+def write_spliced(fd, data, edits):
+    """Write ``data`` with ``edits`` applied to ``fd``; the untouched ranges go to ``os.writev`` without a copy."""
+    with memoryview(data) as view:
+        buffers = []
+        position = 0
+        for start, end, text in edits:
+            buffers += [view[position:start], text]
+            position = end
+        buffers.append(view[position:])
+        write_buffers(fd, buffers)
+
+
+def patch_file(file_path, rules, snapshot=None):
+    """Run ``file_path`` through ``rules`` and atomically replace it if any rule matched.
+
+    Rules whose needles don't occur in the file are dropped first; if none
+    are left the file is neither decoded nor rewritten. The rest run in the
+    passes given by ``stages``: a run of line rules streams the file, so
+    memory use doesn't grow with it, while a splicing rule finds its
+    methods through a ``MethodIndex`` of the file, built in one scan and
+    shifted past its own edits for the next splicing pass, and writes the
+    untouched byte ranges and its new bodies with ``os.writev``. Each pass
+    that has output writes a temporary file next to the original; the last
+    one is swapped in with ``os.replace``, so an interrupted run never
+    leaves a truncated file behind. The original is saved in ``snapshot``
+    just before it is replaced.
+    """
+    with tracing.span(file_path, "file", rules=[rule.name for rule in rules]) as counters:
+        stats = SiteStats()
+        rules = prefilter(file_path, rules)
+        if not rules:
+            counters["files_skipped"] += 1
+            return stats
+
+        logging.info(f"Modifying file: {file_path}")
+        counters["bytes_read"] += os.path.getsize(file_path)
+        directory, base_name = os.path.split(file_path)
+        source = file_path
+        methods = None
+        temp_paths = []
+        try:
+            for group in stages(rules):
+                if group[0].splicing:
+                    with mapped(source) as data:
+                        methods = methods if methods is not None else MethodIndex.build(data)
+                        edits = group[0].splices(data, methods, stats)
+                        if not edits:
+                            continue
+                        fd, temp_path = tempfile.mkstemp(dir=directory or None, prefix=f".{base_name}.",
+                                                         suffix=".tmp")
+                        temp_paths.append(temp_path)
+                        with open(fd, 'wb') as output:
+                            write_spliced(output.fileno(), data, edits)
+                    counters["splices"] += len(edits)
+                    methods = methods.spliced(edits)
+                else:
+                    fd, temp_path = tempfile.mkstemp(dir=directory or None, prefix=f".{base_name}.", suffix=".tmp")
+                    temp_paths.append(temp_path)
+                    with open(fd, 'w') as output, open(source, 'r') as file:
+                        stream = counted(file, counters)
+                        for rule in group:
+                            stream = rule.apply(stream, stats)
+                        output.writelines(stream)
+                    methods = None
+                source = temp_path
+            if stats:
+                size = os.path.getsize(source)
+                shutil.copymode(file_path, source)
+                if snapshot is not None:
+                    snapshot.save(file_path)
+                os.replace(source, file_path)
+                counters["bytes_written"] += size
+        finally:
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        counters.update(rules_matched=sum(stats.values()), **{f"rule:{name}": n for name, n in stats.items()},
+                        **{f"already:{name}": n for name, n in stats.already.items()})
+        logging.info(f"Completed modification for file: {file_path}")
+        return stats
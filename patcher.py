@@ -0,0 +1,418 @@
+import argparse
+import importlib.util
+import logging
+import os
+import re
+import shutil
+import sys
+import zipfile
+
+import dex_patch
+import tracing
+from cache import CachedTools, ResultCache, SmaliTreeCache, file_digest, fingerprint
+from checkpoint import StageManifest
+from dex_index import targets_by_dex
+from jar_writer import changed_dex_entries, write_jar
+from patch_engine import write_manifest
+from pipeline import Pipeline
+from rule_pack import read_pack
+from smali_server import BAKSMALI_JAR, SMALI_JAR, TOOL_MEMORY, JavaTools, SmaliServer, tool_slots
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEX_NAME = re.compile(r'^classes(\d*)\.dex$')
+# Stage manifest in the work dir, read by --resume
+STAGE_MANIFEST = "stages.json"
+
+JARS = {
+    "framework": {
+        "jar": "framework.jar",
+        "prefix": "classes",
+        "script": "framework_patch.py",
+        "pack": "framework",
+        "options": ["core"],
+        "module_path": "system/framework/framework.jar",
+    },
+    "services": {
+        "jar": "services.jar",
+        "prefix": "services_classes",
+        "script": "services_patch.py",
+        "pack": "services",
+        "options": ["isCN"],
+        "module_path": "system/framework/services.jar",
+    },
+    "miui_services": {
+        "jar": "miui-services.jar",
+        "prefix": "miui_services_classes",
+        "script": "miui-service_Patch.py",
+        "pack": "miui_services",
+        "options": [],
+        "module_path": "system/system_ext/framework/miui-services.jar",
+    },
+    "miui_framework": {
+        "jar": "miui-framework.jar",
+        "prefix": "miui_framework_classes",
+        "script": "miui-framework_patch.py",
+        "pack": "miui_framework",
+        "options": [],
+        "module_path": "system/system_ext/framework/miui-framework.jar",
+    },
+}
+
+
+def load_script(file_name):
+    module_name = os.path.splitext(file_name)[0].replace('-', '_').lower()
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPT_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# Code that shapes every patched jar, on top of each jar's own script
+SHARED_CODE = ["patch_engine.py", "method_index.py", "rule_pack.py", "dex_index.py", "dex_patch.py", "jar_writer.py",
+               "patcher.py", "SmaliServer.java"]
+
+
+def build_engine(spec, options):
+    return load_script(spec["script"]).build_engine(*[getattr(options, option) for option in spec["options"]])
+
+
+def patch_code(spec):
+    """The files, relative to ``SCRIPT_DIR``, whose contents decide how a jar is patched."""
+    packs = [os.path.relpath(path, SCRIPT_DIR) for path in read_pack(spec["pack"])[1]]
+    code = [spec["script"]] + packs + SHARED_CODE + [os.path.basename(BAKSMALI_JAR), os.path.basename(SMALI_JAR)]
+    return [file for file in code if os.path.exists(os.path.join(SCRIPT_DIR, file))]
+
+
+def jar_key(jar_path, spec, options):
+    """Cache key of one aligned jar: its input, the options its rules read and the code that patches it."""
+    code_digests = [(file, file_digest(os.path.join(SCRIPT_DIR, file))) for file in patch_code(spec)]
+    return "jar-" + fingerprint(file_digest(jar_path), options.api_level, options.backend, options.all_dex,
+                                *[(option, getattr(options, option)) for option in spec["options"]],
+                                *code_digests) + ".jar"
+
+
+def module_key(jar_keys, output_path):
+    template = os.path.join(SCRIPT_DIR, "magisk_module")
+    template_digests = [(os.path.relpath(os.path.join(root, file), template), file_digest(os.path.join(root, file)))
+                        for root, dirs, files in sorted(os.walk(template)) for file in sorted(files)]
+    return "module-" + fingerprint(sorted(jar_keys.items()), os.path.basename(output_path),
+                                   *template_digests) + ".zip"
+
+
+def patch(engine, directories, options, changed_path=None):
+    """Patch ``directories``; return the files that carry patches, also listed in ``changed_path``."""
+    changed = []
+    engine.apply(directories, jobs=options.jobs, changed=changed)
+    if changed_path is not None:
+        if os.path.exists(changed_path):
+            os.remove(changed_path)
+        write_manifest(changed_path, changed)
+    return changed
+
+
+def read_changed(changed_path):
+    with open(changed_path) as file:
+        return [line.rstrip('\n') for line in file]
+
+
+def assemble_if_changed(tools, directory, dex_path, changed, api_level):
+    """Reassemble ``directory`` into ``dex_path`` unless no file in it was patched."""
+    if not any(path.startswith(os.path.join(directory, "")) for path in changed):
+        logging.info(f"No changes in {directory}; keeping the original {os.path.basename(dex_path)}")
+        return
+    tools.assemble(directory, dex_path, api_level)
+
+
+def patch_dex_directly(tools, engine, jar_path, dex_name, class_rules, extract_dir, directory, options):
+    """Patch ``dex_name`` of ``jar_path`` in memory and write the new image into ``extract_dir``."""
+    data = read_entry(jar_path, dex_name)
+    dex_path = os.path.join(extract_dir, dex_name)
+    try:
+        image, _ = dex_patch.patch_dex_data(data, class_rules, f"{jar_path}!{dex_name}")
+    except dex_patch.UnsupportedRule as e:
+        logging.warning(f"Cannot patch {dex_name} of {jar_path} in place ({e}); falling back to smali")
+        with open(dex_path, 'wb') as file:
+            file.write(data)
+        disassemble(tools, dex_path, directory, options.api_level)
+        changed = patch(engine.subset(class_rules), [directory], options)
+        assemble_if_changed(tools, directory, dex_path, changed, options.api_level)
+        return
+    if image is not None:
+        with open(dex_path, 'wb') as file:
+            file.write(image)
+        tracing.count(bytes_written=len(image))
+    elif os.path.exists(dex_path):
+        os.remove(dex_path)
+
+
+def dex_names(jar_path):
+    """Every ``classesN.dex`` entry of ``jar_path``, in dex order."""
+    with zipfile.ZipFile(jar_path) as jar:
+        matches = [DEX_NAME.match(name) for name in jar.namelist()]
+    return [match.group(0) for match in sorted(filter(None, matches), key=lambda match: int(match.group(1) or 1))]
+
+
+def smali_dir(prefix, dex_name):
+    return prefix + dex_name[len("classes"):-len(".dex")]
+
+
+def read_entry(jar_path, name):
+    with zipfile.ZipFile(jar_path) as jar:
+        data = jar.read(name)
+    tracing.count(bytes_read=len(data))
+    return data
+
+
+def extract(jar_path, dex_names, extract_dir):
+    """Stream only ``dex_names`` out of ``jar_path``; every other entry is copied later by ``pack``."""
+    if os.path.exists(extract_dir):
+        shutil.rmtree(extract_dir)
+    os.makedirs(extract_dir)
+    with zipfile.ZipFile(jar_path) as jar:
+        for dex_name in dex_names:
+            with jar.open(dex_name) as source, open(os.path.join(extract_dir, dex_name), 'wb') as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+            tracing.count(bytes_read=jar.getinfo(dex_name).compress_size,
+                          bytes_written=jar.getinfo(dex_name).file_size)
+
+
+def disassemble(tools, dex_path, output_dir, api_level):
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    tools.disassemble(dex_path, output_dir, api_level)
+    tracing.count(bytes_read=os.path.getsize(dex_path), bytes_written=tracing.tree_size(output_dir))
+
+
+def pack(jar_path, extract_dir, aligned_jar):
+    """Write ``aligned_jar`` from the stock jar with the dex files in ``extract_dir`` that changed swapped in."""
+    replacements = changed_dex_entries(jar_path, extract_dir)
+    write_jar(jar_path, aligned_jar, replacements)
+    logging.info(f"Packed {aligned_jar} ({', '.join(sorted(replacements)) or 'no dex changes'})")
+    tracing.count(bytes_read=os.path.getsize(jar_path), bytes_written=os.path.getsize(aligned_jar))
+
+
+def build_module(aligned_jars, work_dir, output_path):
+    module_dir = os.path.join(work_dir, "magisk_module")
+    if os.path.exists(module_dir):
+        shutil.rmtree(module_dir)
+    shutil.copytree(os.path.join(SCRIPT_DIR, "magisk_module"), module_dir)
+
+    for name, aligned_jar in aligned_jars.items():
+        target = os.path.join(module_dir, JARS[name]["module_path"])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(aligned_jar, target)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as module_zip:
+        for root, dirs, files in os.walk(module_dir):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                module_zip.write(file_path, os.path.relpath(file_path, module_dir))
+    tracing.count(bytes_written=os.path.getsize(output_path))
+    logging.info(f"Created Magisk module: {output_path}")
+
+
+def pack_and_store(jar_path, extract_dir, aligned_jar, results, key):
+    pack(jar_path, extract_dir, aligned_jar)
+    if results is not None:
+        results.store(key, aligned_jar)
+
+
+def module_and_store(aligned_jars, work_dir, output_path, results, key):
+    build_module(aligned_jars, work_dir, output_path)
+    if results is not None:
+        results.store(key, output_path)
+
+
+def add_jar_stages(pipeline, tools, name, jar_path, work_dir, aligned_jar, options, results=None, key=None, tag=None):
+    """Add the stages that turn ``jar_path`` into ``aligned_jar``; return the name of the last one.
+
+    Stage names are suffixed with ``tag`` (the jar name by default) so that
+    several builds of the same jar can share one pipeline.
+    """
+    spec = JARS[name]
+    tag = tag or name
+    extract_dir = os.path.join(work_dir, name)
+    engine = build_engine(spec, options)
+    if options.all_dex:
+        targets = {dex: list(engine.rules) for dex in dex_names(jar_path)}
+    else:
+        targets = targets_by_dex(jar_path, dex_names(jar_path), engine.rules)
+        found = {class_file for class_files in targets.values() for class_file in class_files}
+        for class_file in engine.rules:
+            if class_file not in found and class_file not in engine.optional:
+                logging.warning(f"Class not found in {jar_path}: {class_file}")
+    direct = {}
+    if options.backend == "dex" and not options.all_dex:
+        direct = {dex: {class_file: engine.rules[class_file] for class_file in class_files}
+                  for dex, class_files in targets.items()
+                  if dex_patch.supports([rule for class_file in class_files for rule in engine.rules[class_file]])}
+    dexes = [dex for dex in targets if dex not in direct]
+    # The smali side only patches the classes of the dexes that weren't patched in place
+    smali_engine = engine.subset({class_file for dex in dexes for class_file in targets[dex]})
+    directories = [os.path.join(work_dir, smali_dir(spec["prefix"], dex)) for dex in dexes]
+    changed_path = os.path.join(work_dir, f"{name}_changed.txt")
+    code = [os.path.join(SCRIPT_DIR, file) for file in patch_code(spec)]
+    rule_options = [(option, getattr(options, option)) for option in spec["options"]]
+
+    extract_stage = pipeline.add(f"extract:{tag}", lambda j=jar_path, x=dexes, d=extract_dir: extract(j, x, d),
+                                 inputs=[jar_path], outputs=[os.path.join(extract_dir, dex) for dex in dexes],
+                                 params=dexes)
+    disassemble_stages = [
+        pipeline.add(f"disassemble:{tag}:{dex}",
+                     lambda s=os.path.join(extract_dir, dex), d=directory:
+                     disassemble(tools, s, d, options.api_level),
+                     [extract_stage], outputs=[directory], params=[options.api_level])
+        for dex, directory in zip(dexes, directories)
+    ]
+    patch_stage = None
+    if directories:
+        patch_stage = pipeline.add(f"patch:{tag}",
+                                   lambda e=smali_engine, d=directories, c=changed_path: patch(e, d, options, c),
+                                   [extract_stage] + disassemble_stages, inputs=code,
+                                   outputs=directories + [changed_path], params=rule_options)
+    assemble_stages = [
+        pipeline.add(f"assemble:{tag}:{dex}",
+                     lambda s=directory, d=os.path.join(extract_dir, dex), c=changed_path:
+                     assemble_if_changed(tools, s, d, read_changed(c), options.api_level),
+                     [patch_stage], outputs=[os.path.join(extract_dir, dex)], params=[options.api_level])
+        for dex, directory in zip(dexes, directories)
+    ]
+    direct_stages = [
+        pipeline.add(f"dexpatch:{tag}:{dex}",
+                     lambda e=engine, j=jar_path, x=dex, r=class_rules, s=extract_dir,
+                     d=os.path.join(work_dir, smali_dir(spec["prefix"], dex)):
+                     patch_dex_directly(tools, e, j, x, r, s, d, options),
+                     [extract_stage], inputs=[jar_path] + code, outputs=[os.path.join(extract_dir, dex)],
+                     params=rule_options + [options.api_level])
+        for dex, class_rules in direct.items()
+    ]
+    # The pack stage also aligns: jar_writer writes the entries zipalign-ed
+    return pipeline.add(f"pack:{tag}",
+                        lambda j=jar_path, d=extract_dir, a=aligned_jar: pack_and_store(j, d, a, results, key),
+                        assemble_stages + direct_stages or [patch_stage or extract_stage], inputs=[jar_path],
+                        outputs=[aligned_jar])
+
+
+def build_pipeline(options, tools, results=None, checkpoints=None):
+    """Build the stage DAG; return ``None`` if ``results`` already holds the module.
+
+    Stages are recorded in ``checkpoints`` (a ``checkpoint.StageManifest``)
+    and, with ``options.resume``, skipped when they are up to date.
+    """
+    pipeline = Pipeline(checkpoints, getattr(options, "resume", False))
+    work_dir = options.work_dir
+    aligned_jars = {}
+    pack_stages = []
+    jar_keys = {}
+    cached_jars = []
+
+    for name, spec in JARS.items():
+        jar_path = os.path.join(options.jars_dir, spec["jar"])
+        if not os.path.exists(jar_path):
+            logging.warning(f"{spec['jar']} not found, skipping.")
+            continue
+
+        aligned_jar = os.path.join(work_dir, f"aligned_{name}.jar")
+        aligned_jars[name] = aligned_jar
+        jar_keys[name] = jar_key(jar_path, spec, options) if results is not None else None
+        if results is not None and not options.rebuild and results.fetch(jar_keys[name], aligned_jar):
+            cached_jars.append(name)
+            continue
+        pack_stages.append(add_jar_stages(pipeline, tools, name, jar_path, work_dir, aligned_jar, options,
+                                          results, jar_keys[name]))
+
+    if not aligned_jars:
+        return pipeline
+    key = module_key(jar_keys, options.output) if results is not None else None
+    if results is not None and not options.rebuild and results.fetch(key, options.output):
+        return None
+    if cached_jars:
+        logging.info(f"Rebuilding {len(aligned_jars) - len(cached_jars)} of {len(aligned_jars)} jars; "
+                     f"reusing {', '.join(cached_jars)}")
+    pipeline.add("module", lambda: module_and_store(aligned_jars, work_dir, options.output, results, key),
+                 pack_stages, inputs=list(aligned_jars.values()) + [os.path.join(SCRIPT_DIR, "magisk_module")],
+                 outputs=[options.output])
+    return pipeline
+
+
+def stage_manifest(options):
+    """The work dir's stage manifest with ``--checkpoint`` or ``--resume``, else ``None`` so nothing is hashed."""
+    if options.checkpoint or options.resume:
+        return StageManifest(os.path.join(options.work_dir, STAGE_MANIFEST))
+    return None
+
+
+def module_name(device_name, version):
+    if device_name and version:
+        return f"moded_framework_services_{device_name}_{version}.zip"
+    return "moded_framework_services.zip"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Patch framework, services and MIUI jars concurrently")
+    parser.add_argument("--api-level", dest="api_level", default="34", help="Android API level")
+    parser.add_argument("--core", default="false", help="apply the core patch (true/false)")
+    parser.add_argument("--isCN", default="true", help="the ROM is a China build (true/false)")
+    parser.add_argument("--jars-dir", default=".", help="directory holding the stock jars")
+    parser.add_argument("--work-dir", default="build", help="directory for intermediate files")
+    parser.add_argument("--device-name", help="device name used in the module file name")
+    parser.add_argument("--version", help="ROM version used in the module file name")
+    parser.add_argument("--output", help="path of the Magisk module zip")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="size of the worker pool")
+    parser.add_argument("--all-dex", action="store_true",
+                        help="disassemble every dex instead of only those containing patch targets")
+    parser.add_argument("--backend", choices=["smali", "dex"], default="smali",
+                        help="patch dex files in place where every rule allows it, instead of via baksmali/smali")
+    parser.add_argument("--cache-dir",
+                        help="reuse disassembled smali trees and finished jars/modules cached in this directory")
+    parser.add_argument("--cache-size", type=int, default=4096, help="size cap in MiB of the whole cache dir")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="build everything again instead of reusing cached jars/modules")
+    parser.add_argument("--batch-jvm", action="store_true",
+                        help="run every baksmali/smali job in one long-lived JVM instead of one JVM per dex")
+    parser.add_argument("--tool-memory", type=int, default=TOOL_MEMORY,
+                        help="MiB one baksmali/smali job needs; caps how many run at once")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="record finished stages in the work dir's stage manifest, so --resume can skip them")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the stages recorded in the work dir's stage manifest whose inputs are unchanged "
+                             "(implies --checkpoint)")
+    tracing.add_arguments(parser)
+    options = parser.parse_args()
+    tracing.configure(options)
+
+    options.core = options.core.lower() == 'true'
+    options.isCN = options.isCN.lower() == 'true'
+    if options.output is None:
+        options.output = os.path.join("out", module_name(options.device_name, options.version))
+    os.makedirs(options.work_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(options.output) or ".", exist_ok=True)
+
+    results = ResultCache(options.cache_dir, options.cache_size << 20) if options.cache_dir else None
+    slots = tool_slots(options.jobs, options.tool_memory)
+    if options.batch_jvm:
+        tools = SmaliServer(threads=slots, tool_memory=options.tool_memory)
+    else:
+        tools = JavaTools(max_parallel=slots)
+    if options.cache_dir:
+        tools = CachedTools(tools, SmaliTreeCache(options.cache_dir, options.cache_size << 20, BAKSMALI_JAR))
+    try:
+        with tools:
+            pipeline = build_pipeline(options, tools, results, stage_manifest(options))
+            if pipeline is None:
+                logging.info(f"Module is up to date: {options.output}")
+                return
+            pipeline.run(jobs=options.jobs)
+    finally:
+        tracing.write_outputs(options)
+
+
+if __name__ == "__main__":
+    main()
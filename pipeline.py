@@ -0,0 +1,82 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import tracing
+
+
+class Pipeline:
+    """A DAG of named stages run on a bounded worker pool.
+
+    A stage starts as soon as every stage it depends on has finished, so
+    independent jars (and independent dex files within a jar) overlap.
+
+    With ``checkpoints`` (a ``checkpoint.StageManifest``) every finished
+    stage is recorded with the key of its ``params``, ``inputs`` and
+    dependencies and the digests of its ``outputs``; with ``resume`` a stage
+    whose key and outputs are unchanged since it was recorded is skipped.
+    """
+
+    def __init__(self, checkpoints=None, resume=False):
+        self.stages = {}
+        self.checkpoint_specs = {}
+        self.checkpoints = checkpoints
+        self.resume = resume
+
+    def add(self, name, func, deps=(), inputs=(), outputs=(), params=()):
+        if name in self.stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stages: {', '.join(missing)}")
+        self.stages[name] = (func, tuple(deps))
+        self.checkpoint_specs[name] = (tuple(params), tuple(inputs), tuple(outputs))
+        return name
+
+    def run(self, jobs=1):
+        pending = dict(self.stages)
+        done = set()
+        running = {}
+        failed = []
+
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            while running or (pending and not failed):
+                if not failed:
+                    for name, (func, deps) in list(pending.items()):
+                        if all(dep in done for dep in deps):
+                            del pending[name]
+                            running[executor.submit(self._run_stage, name, func, deps)] = name
+
+                if not running:
+                    raise RuntimeError(f"Unsatisfiable stages: {', '.join(pending)}")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"Stage {name} failed: {e}")
+                        failed.append((name, e))
+                    else:
+                        done.add(name)
+
+        if failed:
+            name, error = failed[0]
+            raise RuntimeError(f"Pipeline failed at stage {name}") from error
+
+    def _run_stage(self, name, func, deps):
+        key = None
+        if self.checkpoints is not None:
+            params, inputs, outputs = self.checkpoint_specs[name]
+            key = self.checkpoints.key(name, params, inputs, deps)
+            if self.resume and self.checkpoints.up_to_date(name, key):
+                logging.info(f"Skipping stage {name}: inputs and outputs unchanged")
+                return
+        logging.info(f"Starting stage {name}")
+        start = time.monotonic()
+        with tracing.span(name, "stage"):
+            func()
+        if key is not None:
+            self.checkpoints.record(name, key, outputs, deps)
+        logging.info(f"Finished stage {name} in {time.monotonic() - start:.2f}s")
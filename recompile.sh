@@ -1,39 +1,47 @@
-if [ -d classes ]; then
-  java -jar smali.jar a -a 35 classes -o framework/classes.dex
-else
-  echo "classes directory not found, skipping recompilation."
-fi
-
-for i in {2..5}; do
-  if [ -d "classes$i" ]; then
-    java -jar smali.jar a -a 35 "classes$i" -o "framework/classes$i.dex"
-  else
-    echo "classes$i directory not found, skipping recompilation."
+# Directories the patch scripts changed are listed in patch_manifest.txt
+# (--manifest); the others keep their original dex. Without a manifest
+# everything is reassembled.
+needs_assembly() {
+  [ ! -f patch_manifest.txt ] || grep -q "^$1/" patch_manifest.txt
+}
+
+# Run at most $(nproc) smali JVMs at once; drain waits for the rest
+running=0
+spawn() {
+  "$@" &
+  running=$((running + 1))
+  if [ "$running" -ge "$(nproc)" ]; then
+    wait -n
+    running=$((running - 1))
   fi
-done
-
-if [ -d services_classes ]; then
-  java -jar smali.jar a -a 35 services_classes -o services/classes.dex
-else
-  echo "services_classes directory not found, skipping recompilation."
-fi
-
-for i in {2..5}; do
-  if [ -d "services_classes$i" ]; then
-    java -jar smali.jar a -a 35 "services_classes$i" -o "services/classes$i.dex"
-  else
-    echo "services_classes$i directory not found, skipping recompilation."
-  fi
-done
-
-cd framework
-7z a -tzip ../framework_new.zip *
-cd ../services
-7z a -tzip ../services_new.zip *
-cd ..
-
-zipalign -f -p -v -z 4 framework_new.zip aligned_framework.jar
-zipalign -f -p -v -z 4 services_new.zip aligned_services.jar
+}
+drain() {
+  while [ "$running" -gt 0 ]; do
+    wait -n
+    running=$((running - 1))
+  done
+}
+
+# recompile <smali prefix> <jar dir>: every changed <prefix>N back into classesN.dex, in parallel
+recompile() {
+  for dir in "$1"*; do
+    n=${dir#"$1"}
+    case "$n" in *[!0-9]*) continue ;; esac
+    [ -d "$dir" ] || continue
+    if needs_assembly "$dir"; then
+      spawn java -jar smali.jar a -a 35 "$dir" -o "$2/classes$n.dex"
+    else
+      echo "$dir unchanged, keeping original classes$n.dex."
+    fi
+  done
+}
+
+recompile classes framework
+recompile services_classes services
+drain
+
+python3 jar_writer.py framework.jar framework aligned_framework.jar
+python3 jar_writer.py services.jar services aligned_services.jar
 
 
 mkdir -p magisk_module/system/framework
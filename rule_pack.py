@@ -0,0 +1,194 @@
+import argparse
+import json
+import logging
+import os
+import pickle
+import sys
+import tempfile
+
+from patch_engine import (PatchEngine, MethodBodyRule, InsertBeforeRule, InsertAfterMoveResultRule,
+                          ReplaceInMethodRule, InsertAfterRule, ReplaceStringRule, RemoveBranchRule)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+RULES_DIR = os.path.join(SCRIPT_DIR, "rules")
+CACHE_DIR = os.path.join(RULES_DIR, "__pycache__")
+# Code whose changes make a compiled pack stale, on top of the pack files themselves
+COMPILER_CODE = [os.path.abspath(__file__), os.path.join(SCRIPT_DIR, "patch_engine.py")]
+
+
+def method_body_rule(name, definition, body):
+    methods = {key: (method["pattern"], body(method["body"])) for key, method in definition["methods"].items()}
+    return MethodBodyRule(methods, keep_registers=definition.get("keep_registers", True),
+                          requires=definition.get("requires"), name=name)
+
+
+# Rule kind -> builder taking (name, definition, body), where body() expands a pack body into lines
+RULE_KINDS = {
+    "method_body": method_body_rule,
+    "insert_before": lambda name, definition, body: InsertBeforeRule(
+        definition["pattern"], definition["line"] + "\n", name=name),
+    "move_result": lambda name, definition, body: InsertAfterMoveResultRule(
+        definition["pattern"], definition["value"], lookahead=definition.get("lookahead"),
+        replace=definition.get("replace", False), name=name),
+    "replace_in_method": lambda name, definition, body: ReplaceInMethodRule(
+        definition["method"], definition["search"], definition["replace"], name=name),
+    "insert_after": lambda name, definition, body: InsertAfterRule(
+        definition["pattern"], definition["line"], name=name),
+    "replace_string": lambda name, definition, body: ReplaceStringRule(
+        definition["search"], definition["replace"], name=name),
+    "remove_branch": lambda name, definition, body: RemoveBranchRule(definition["pattern"], name=name),
+}
+
+_loaded = {}
+
+
+def pack_path(name):
+    return os.path.join(RULES_DIR, f"{name}.json")
+
+
+def read_pack(name, seen=()):
+    """Read pack ``name`` with its includes merged in; return it and the paths of every file read.
+
+    An included pack contributes its bodies and rules (not its classes);
+    the including pack's own definitions win. A rule with ``extends``
+    starts from the earlier rule of that name, merging ``methods`` entry by
+    entry.
+    """
+    if name in seen:
+        raise ValueError(f"Rule pack include cycle: {' -> '.join(seen + (name,))}")
+    with open(pack_path(name)) as file:
+        pack = json.load(file)
+    paths = [pack_path(name)]
+    bodies, rules = {}, {}
+    for include in pack.get("include", []):
+        included, included_paths = read_pack(include, seen + (name,))
+        bodies.update(included["bodies"])
+        rules.update(included["rules"])
+        paths += included_paths
+    bodies.update(pack.get("bodies", {}))
+    for rule_name, definition in pack.get("rules", {}).items():
+        if "extends" in definition:
+            base = rules.get(definition["extends"])
+            if base is None:
+                raise ValueError(f"{name}: {rule_name} extends unknown rule {definition['extends']}")
+            methods = {key: dict(method) for key, method in base.get("methods", {}).items()}
+            for key, method in definition.get("methods", {}).items():
+                methods.setdefault(key, {}).update(method)
+            definition = dict(base, **{key: value for key, value in definition.items()
+                                       if key not in ("extends", "methods")}, methods=methods)
+        rules[rule_name] = definition
+    return {"bodies": bodies, "rules": rules, "classes": pack.get("classes", [])}, paths
+
+
+def enabled(entry, options):
+    """Whether a class or method entry applies; ``when`` names an option that must be true."""
+    when = entry.get("when")
+    if when is None:
+        return True
+    if when not in options:
+        raise ValueError(f"Rule pack condition on unknown option: {when}")
+    return bool(options[when])
+
+
+def compile_pack(name, options):
+    """Build the ``PatchEngine`` described by pack ``name`` for ``options``; also return the files read."""
+    pack, paths = read_pack(name)
+
+    def body(lines):
+        expanded = []
+        for line in lines:
+            if line.startswith("@"):
+                if line[1:] not in pack["bodies"]:
+                    raise ValueError(f"{name}: unknown body {line}")
+                expanded += [body_line + "\n" for body_line in pack["bodies"][line[1:]]]
+            else:
+                expanded.append(line + "\n")
+        return expanded
+
+    compiled = {}
+    engine = PatchEngine()
+    for entry in pack["classes"]:
+        if not enabled(entry, options):
+            continue
+        rules = []
+        for rule_name in entry["rules"]:
+            if rule_name not in compiled:
+                definition = pack["rules"].get(rule_name)
+                if definition is None:
+                    raise ValueError(f"{name}: {entry['class']} uses unknown rule {rule_name}")
+                if definition.get("kind") not in RULE_KINDS:
+                    raise ValueError(f"{name}: {rule_name} has unknown kind {definition.get('kind')}")
+                if "methods" in definition:
+                    definition = dict(definition, methods={key: method for key, method in definition["methods"].items()
+                                                           if enabled(method, options)})
+                compiled[rule_name] = RULE_KINDS[definition["kind"]](rule_name, definition, body)
+            rules.append(compiled[rule_name])
+        engine.register(entry["class"], *rules, optional=entry.get("optional", False))
+    return engine, paths
+
+
+def _stamp(paths):
+    return [(path, os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in paths]
+
+
+def cache_path(name, options):
+    tag = ",".join(f"{key}={options[key]}" for key in sorted(options)) or "default"
+    return os.path.join(CACHE_DIR, f"{name}.{tag}.{sys.implementation.cache_tag}.pickle")
+
+
+def load_pack(name, **options):
+    """Return the compiled ``PatchEngine`` for pack ``name``, reusing the cached compile if it is current.
+
+    Like a ``.pyc`` file, the cache records the size and mtime of every pack
+    file and of the compiler; if any of them changed the pack is compiled
+    again and the cache rewritten.
+    """
+    key = (name, tuple(sorted(options.items())))
+    if key in _loaded:
+        return _loaded[key]
+
+    path = cache_path(name, options)
+    engine = None
+    try:
+        with open(path, 'rb') as file:
+            sources, cached = pickle.load(file)
+        if _stamp(source for source, _, _ in sources) == sources:
+            engine = cached
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        pass
+
+    if engine is None:
+        engine, paths = compile_pack(name, options)
+        temp_path = None
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+            with open(fd, 'wb') as file:
+                pickle.dump((_stamp(paths + COMPILER_CODE), engine), file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.debug(f"Cannot cache compiled rule pack {name}: {e}")
+        finally:
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    _loaded[key] = engine
+    return engine
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile a rule pack and print its class -> rules table")
+    parser.add_argument("name", help="pack name (a file in rules/ without .json)")
+    parser.add_argument("options", nargs="*", help="pack options as name=true/false, e.g. core=true")
+    args = parser.parse_args()
+
+    options = {}
+    for option in args.options:
+        option_name, _, value = option.partition("=")
+        options[option_name] = value.lower() == 'true'
+    engine, _ = compile_pack(args.name, options)
+    for class_file, rules in engine.rules.items():
+        optional = " (optional)" if class_file in engine.optional else ""
+        print(f"{class_file}{optional}: {', '.join(rule.name for rule in rules)}")
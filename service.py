@@ -0,0 +1,379 @@
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from argparse import Namespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cache import CachedTools, DownloadCache, ResultCache, SmaliTreeCache, file_digest
+from patcher import JARS, build_pipeline, module_name
+from smali_server import BAKSMALI_JAR, TOOL_MEMORY, JavaTools, SmaliServer, tool_slots
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Job inputs, named as in patcher.yml's workflow_dispatch
+JAR_INPUTS = {name: f"{name}_jar_url" for name in JARS}
+JOB_PATH = re.compile(r'^/jobs/([0-9a-f]{32})(/artifact)?$')
+URL = re.compile(r'^https?://')
+DOWNLOAD_TIMEOUT = 60
+JOB_TTL = 24 * 60 * 60
+
+
+def parse_bool(value):
+    return value if isinstance(value, bool) else str(value).lower() == 'true'
+
+
+class Job:
+    def __init__(self, inputs):
+        self.id = uuid.uuid4().hex
+        self.inputs = inputs
+        self.status = "queued"
+        self.error = None
+        self.output = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def describe(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "artifact": f"/jobs/{self.id}/artifact" if self.status == "done" else None,
+            "artifact_name": os.path.basename(self.output) if self.output else None,
+        }
+
+
+class PatchService:
+    """A job queue drained by worker threads that share one warm set of tools and caches.
+
+    The smali tools (one long-lived JVM unless ``jvm_per_dex``), the smali
+    tree cache and the result cache are created once and used by every job,
+    so a job whose jars were patched before is served from the cache.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.results = ResultCache(options.cache_dir, options.cache_size << 20)
+        slots = tool_slots(options.jobs, options.tool_memory)
+        if options.jvm_per_dex:
+            tools = JavaTools(max_parallel=slots)
+        else:
+            tools = SmaliServer(threads=slots, tool_memory=options.tool_memory)
+        self.tools = CachedTools(tools, SmaliTreeCache(options.cache_dir, options.cache_size << 20, BAKSMALI_JAR))
+        self.downloads = DownloadCache(options.cache_dir, options.cache_size << 20)
+        self.download_dir = self.downloads.root
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(options.workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, inputs):
+        sources = [inputs[key] for key in JAR_INPUTS.values() if inputs.get(key)]
+        if not sources:
+            raise ValueError(f"At least one of {', '.join(JAR_INPUTS.values())} is required")
+        for source in sources:
+            if not isinstance(source, str) or not (URL.match(source) or self.options.allow_local_paths):
+                raise ValueError(f"Not an http(s) URL: {source} (local paths need --allow-local-paths)")
+        self.expire()
+        job = Job(inputs)
+        with self.lock:
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        logging.info(f"Queued job {job.id}")
+        return job
+
+    def get(self, job_id):
+        self.expire()
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        self.expire()
+        with self.lock:
+            return [job.describe() for job in self.jobs.values()]
+
+    def expire(self):
+        """Forget jobs that finished more than ``job_ttl`` seconds ago and delete their modules."""
+        deadline = time.time() - self.options.job_ttl
+        with self.lock:
+            expired = [job for job in self.jobs.values() if job.finished is not None and job.finished < deadline]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            logging.info(f"Expiring job {job.id}")
+            shutil.rmtree(os.path.join(self.options.output_dir, job.id), ignore_errors=True)
+
+    def close(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.tools.close()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.status, job.started = "running", time.time()
+            try:
+                self._run(job)
+                job.status = "done"
+            except Exception as e:
+                logging.error(f"Job {job.id} failed: {e}")
+                job.status, job.error = "failed", str(e)
+            job.finished = time.time()
+            logging.info(f"Job {job.id} {job.status} in {job.finished - job.started:.2f}s")
+
+    def _run(self, job):
+        job_dir = os.path.join(self.options.work_dir, job.id)
+        jars_dir = os.path.join(job_dir, "jars")
+        os.makedirs(jars_dir, exist_ok=True)
+        try:
+            for name, key in JAR_INPUTS.items():
+                if job.inputs.get(key):
+                    self._fetch(job.inputs[key], os.path.join(jars_dir, JARS[name]["jar"]))
+            self._build(job, job_dir, jars_dir)
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def _build(self, job, job_dir, jars_dir):
+        device_name = job.inputs.get("custom_device_name") or None
+        version = job.inputs.get("custom_version") or None
+        job.output = os.path.join(self.options.output_dir, job.id, module_name(device_name, version))
+        options = Namespace(
+            api_level=str(job.inputs.get("android_api_level") or "34"),
+            core=parse_bool(job.inputs.get("core", False)),
+            isCN=parse_bool(job.inputs.get("isCN", True)),
+            jars_dir=jars_dir, work_dir=job_dir, output=job.output,
+            device_name=device_name, version=version, jobs=self.options.jobs,
+            all_dex=False, backend=self.options.backend, rebuild=False)
+        os.makedirs(os.path.dirname(job.output), exist_ok=True)
+        pipeline = build_pipeline(options, self.tools, self.results)
+        if pipeline is not None:
+            pipeline.run(jobs=options.jobs)
+
+    def _fetch(self, source, target):
+        """Link a local jar into place, or link the cached download of a URL, revalidating it first.
+
+        Downloads are stored under their SHA-256, so a jar shared by several
+        URLs is kept once and a job never sees a file replaced under it. Next
+        to them, each URL's ETag and Last-Modified are kept so later jobs
+        send a conditional request and only download again when the server
+        reports a change. Both count against the cache's size cap like the
+        smali trees and results; the job gets a hard link (or a copy), so an
+        eviction can't pull its jar away mid-build.
+        """
+        if not URL.match(source):
+            if not self.options.allow_local_paths:
+                raise ValueError(f"Local paths are not allowed: {source}")
+            if not os.path.isfile(source):
+                raise FileNotFoundError(f"No such jar: {source}")
+            os.symlink(os.path.abspath(source), target)
+            return
+        meta_path = os.path.join(self.download_dir, hashlib.sha256(source.encode()).hexdigest() + ".json")
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            meta = {}
+        cached = os.path.join(self.download_dir, meta["digest"] + ".jar") if meta.get("digest") else None
+        if cached is None or not os.path.exists(cached) or not (meta.get("etag") or meta.get("last_modified")):
+            # Nothing to revalidate: never downloaded, or the server sent neither header
+            meta, cached = {}, None
+
+        request = urllib.request.Request(source)
+        if meta.get("etag"):
+            request.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            request.add_header("If-Modified-Since", meta["last_modified"])
+        try:
+            with urllib.request.urlopen(request, timeout=self.options.download_timeout) as response:
+                logging.info(f"Downloading {source}")
+                cached = self._download(response)
+                meta = {"digest": os.path.basename(cached)[:-len(".jar")],
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified")}
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or cached is None:
+                raise
+            logging.info(f"Reusing the download of {source}: not modified")
+            self.downloads.touch(cached)
+            self.downloads.touch(meta_path)
+        else:
+            fd, temp_path = tempfile.mkstemp(dir=self.download_dir, prefix=".", suffix=".json")
+            with open(fd, 'w') as file:
+                json.dump(meta, file)
+            os.replace(temp_path, meta_path)
+        try:
+            os.link(cached, target)
+        except OSError:
+            shutil.copyfile(cached, target)
+
+    def _download(self, response):
+        fd, temp_path = tempfile.mkstemp(dir=self.download_dir, prefix=".", suffix=".tmp")
+        try:
+            with open(fd, 'wb') as file:
+                shutil.copyfileobj(response, file, 1 << 20)
+            digest = file_digest(temp_path)
+            self.downloads.commit(temp_path, digest)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return self.downloads.path(digest)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """``POST /jobs`` queues a job; ``GET /jobs[/<id>[/artifact]]`` reports status or serves the module."""
+
+    service = None
+    # Origins whose pages may call the service; requests from any other origin are refused
+    allowed_origins = ()
+    # When set, every request needs ``Authorization: Bearer <token>``
+    token = None
+
+    def do_OPTIONS(self):
+        if self.headers.get("Origin") not in self.allowed_origins:
+            return self._send_json(403, {"error": "origin not allowed"})
+        self.send_response(204)
+        self._cors_headers()
+        self.end_headers()
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path.rstrip('/') != "/jobs":
+            return self._send_json(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            inputs = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(inputs, dict):
+                raise ValueError("Expected a JSON object")
+            job = self.service.submit(inputs)
+        except ValueError as e:
+            return self._send_json(400, {"error": str(e)})
+        self._send_json(202, job.describe())
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path.rstrip('/') == "/jobs":
+            return self._send_json(200, {"jobs": self.service.list_jobs()})
+        match = JOB_PATH.match(self.path)
+        job = self.service.get(match.group(1)) if match else None
+        if job is None:
+            return self._send_json(404, {"error": "not found"})
+        if not match.group(2):
+            return self._send_json(200, job.describe())
+        if job.status != "done":
+            return self._send_json(409, {"error": f"job is {job.status}"})
+
+        self.send_response(200)
+        self._cors_headers()
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(os.path.getsize(job.output)))
+        self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(job.output)}"')
+        self.end_headers()
+        with open(job.output, 'rb') as file:
+            shutil.copyfileobj(file, self.wfile, 1 << 20)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self._cors_headers()
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self):
+        """Refuse requests from pages on other origins and, with a token set, requests without it.
+
+        Browsers send ``Origin`` with every cross-origin request, including
+        the simple POSTs that skip the CORS preflight, so checking it here
+        keeps arbitrary web pages from queueing jobs.
+        """
+        origin = self.headers.get("Origin")
+        if origin is not None and origin not in self.allowed_origins:
+            self._send_json(403, {"error": "origin not allowed"})
+            return False
+        if self.token and not hmac.compare_digest(self.headers.get("Authorization", ""), f"Bearer {self.token}"):
+            self._send_json(401, {"error": "missing or wrong token"})
+            return False
+        return True
+
+    def _cors_headers(self):
+        origin = self.headers.get("Origin")
+        if origin not in self.allowed_origins:
+            return
+        self.send_header("Access-Control-Allow-Origin", origin)
+        self.send_header("Vary", "Origin")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Authorization, Content-Type")
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} - {format % args}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve patch jobs over HTTP from a warm worker pool")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=1, help="jobs run at the same time")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="stage workers per job")
+    parser.add_argument("--work-dir", default="build/service", help="directory for intermediate files")
+    parser.add_argument("--output-dir", default="out/service", help="directory for finished modules")
+    parser.add_argument("--cache-dir", default="cache", help="smali, result and download cache directory")
+    parser.add_argument("--cache-size", type=int, default=4096, help="size cap in MiB of the whole cache dir")
+    parser.add_argument("--backend", choices=["smali", "dex"], default="smali",
+                        help="patch dex files in place where every rule allows it, instead of via baksmali/smali")
+    parser.add_argument("--jvm-per-dex", action="store_true",
+                        help="launch baksmali/smali per dex instead of keeping one JVM running")
+    parser.add_argument("--tool-memory", type=int, default=TOOL_MEMORY,
+                        help="MiB one baksmali/smali job needs; caps how many run at once")
+    parser.add_argument("--allow-origin", action="append", default=[],
+                        help="origin of a web UI allowed to call the service, e.g. http://localhost:5173 (repeatable)")
+    parser.add_argument("--token", default=os.environ.get("PATCH_SERVICE_TOKEN"),
+                        help="require 'Authorization: Bearer TOKEN' on every request "
+                             "(default: $PATCH_SERVICE_TOKEN)")
+    parser.add_argument("--allow-local-paths", action="store_true",
+                        help="accept paths on this machine as jar inputs, not just http(s) URLs")
+    parser.add_argument("--download-timeout", type=float, default=DOWNLOAD_TIMEOUT,
+                        help="seconds to wait on a stalled jar download")
+    parser.add_argument("--job-ttl", type=float, default=JOB_TTL,
+                        help="seconds a finished job and its module are kept")
+    options = parser.parse_args()
+
+    Handler.service = PatchService(options)
+    Handler.allowed_origins = tuple(options.allow_origin)
+    Handler.token = options.token
+    server = ThreadingHTTPServer((options.host, options.port), Handler)
+    logging.info(f"Listening on http://{options.host}:{options.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        Handler.service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import contextlib
+import itertools
+import logging
+import os
+import subprocess
+import threading
+from concurrent.futures import Future
+
+import tracing
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BAKSMALI_JAR = os.path.join(SCRIPT_DIR, "baksmali.jar")
+SMALI_JAR = os.path.join(SCRIPT_DIR, "smali.jar")
+SERVER_SOURCE = os.path.join(SCRIPT_DIR, "SmaliServer.java")
+# Memory a baksmali/smali job needs on a large framework dex, in MiB
+TOOL_MEMORY = 1536
+
+
+def available_memory():
+    """MemAvailable from /proc/meminfo in bytes, or ``None`` where it can't be read."""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) << 10
+    except OSError:
+        pass
+    return None
+
+
+def tool_slots(jobs, tool_memory=TOOL_MEMORY):
+    """How many baksmali/smali jobs may run at once: ``jobs``, or fewer if available memory is short."""
+    memory = available_memory()
+    slots = max(jobs, 1) if memory is None else max(1, min(jobs, memory // (tool_memory << 20)))
+    if slots < jobs:
+        logging.info(f"Running at most {slots} baksmali/smali jobs at once ({memory >> 20} MiB available)")
+    return slots
+
+
+class JavaTools:
+    """Runs baksmali/smali with one JVM launch per dex file, at most ``max_parallel`` at a time."""
+
+    def __init__(self, baksmali_jar=BAKSMALI_JAR, smali_jar=SMALI_JAR, max_parallel=None):
+        self.baksmali_jar = baksmali_jar
+        self.smali_jar = smali_jar
+        self.slots = threading.BoundedSemaphore(max_parallel) if max_parallel else contextlib.nullcontext()
+
+    def disassemble(self, dex_path, output_dir, api_level):
+        self._run(["java", "-jar", self.baksmali_jar, "d", "-a", str(api_level), dex_path, "-o", output_dir])
+
+    def assemble(self, input_dir, dex_path, api_level):
+        self._run(["java", "-jar", self.smali_jar, "a", "-a", str(api_level), input_dir, "-o", dex_path])
+
+    def close(self):
+        pass
+
+    def _run(self, command):
+        with self.slots:
+            logging.info(f"Running: {' '.join(command)}")
+            tracing.run(command)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SmaliServer(JavaTools):
+    """Sends every disassemble/assemble job to one long-lived JVM over a pipe.
+
+    The JVM runs SmaliServer.java with both jars on its classpath and
+    processes up to ``threads`` jobs at once. Calls block until their job is
+    done, so they can be made from several pipeline threads. The heap is
+    capped at ``tool_memory`` MiB per thread, the budget ``tool_slots``
+    sized the thread count by, instead of the JVM's default of a quarter of
+    RAM.
+    """
+
+    def __init__(self, baksmali_jar=BAKSMALI_JAR, smali_jar=SMALI_JAR, threads=None, tool_memory=TOOL_MEMORY):
+        super().__init__(baksmali_jar, smali_jar)
+        threads = threads or os.cpu_count() or 1
+        command = ["java", f"-Xmx{threads * tool_memory}m", "-cp", os.pathsep.join([baksmali_jar, smali_jar]),
+                   SERVER_SOURCE, str(threads)]
+        logging.info(f"Starting smali server: {' '.join(command)}")
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        text=True, encoding="utf-8", bufsize=1)
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.pending = {}
+        self.reader = threading.Thread(target=self._read_replies, daemon=True)
+        self.reader.start()
+
+    def disassemble(self, dex_path, output_dir, api_level):
+        self._request("d", api_level, dex_path, output_dir)
+
+    def assemble(self, input_dir, dex_path, api_level):
+        self._request("a", api_level, input_dir, dex_path)
+
+    def close(self):
+        if self.process.stdin and not self.process.stdin.closed:
+            self.process.stdin.close()
+        self.process.wait()
+        self.reader.join()
+
+    def _request(self, command, api_level, source, target):
+        with tracing.span("baksmali" if command == "d" else "smali", "command", source=source, target=target):
+            self._send(command, api_level, source, target)
+
+    def _send(self, command, api_level, source, target):
+        future = Future()
+        with self.lock:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"smali server exited with code {self.process.returncode}")
+            request_id = str(next(self.ids))
+            self.pending[request_id] = future
+            self.process.stdin.write("\t".join([request_id, command, str(api_level),
+                                                os.path.abspath(source), os.path.abspath(target)]) + "\n")
+            self.process.stdin.flush()
+        logging.info(f"Queued {'baksmali' if command == 'd' else 'smali'} job: {source} -> {target}")
+        future.result()
+
+    def _read_replies(self):
+        for line in self.process.stdout:
+            request_id, status, *message = line.rstrip("\n").split("\t", 2)
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            if future is None:
+                continue
+            if status == "ok":
+                future.set_result(None)
+            else:
+                future.set_exception(RuntimeError(message[0] if message else status))
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError("smali server exited"))
@@ -0,0 +1,94 @@
+import argparse
+import difflib
+import logging
+import os
+import shutil
+import sys
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class Snapshot:
+    """Originals of the files a patch run rewrites, kept under ``root``.
+
+    ``patch_file`` never writes into a file; it renames a new one over it.
+    So a hard link taken before the first rewrite keeps the original bytes
+    without copying them, and the rename breaks the link. Only files that
+    are actually rewritten are saved, which makes a snapshot a few files
+    instead of a copy of every smali tree. Paths are stored relative to
+    ``base`` (the current directory by default).
+    """
+
+    def __init__(self, root, base=None):
+        self.root = os.path.abspath(root)
+        self.base = os.path.abspath(base or os.getcwd())
+
+    def _relative(self, file_path):
+        relative = os.path.relpath(os.path.abspath(file_path), self.base)
+        if relative.startswith(os.pardir + os.sep) or relative == os.pardir:
+            raise ValueError(f"{file_path} is outside {self.base}")
+        return relative
+
+    def save(self, file_path):
+        """Keep ``file_path``'s current contents unless this snapshot already has them."""
+        target = os.path.join(self.root, self._relative(file_path))
+        if os.path.exists(target):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(file_path, target)
+        except FileExistsError:
+            pass
+        except OSError:
+            # Different file system, or no hard links: fall back to a copy
+            temp_path = f"{target}.{os.getpid()}.tmp"
+            shutil.copy2(file_path, temp_path)
+            os.replace(temp_path, target)
+
+    def files(self):
+        """Paths (relative to ``base``) of every saved file."""
+        paths = []
+        for root, dirs, files in os.walk(self.root):
+            dirs.sort()
+            for file in sorted(files):
+                if not file.endswith(".tmp"):
+                    paths.append(os.path.relpath(os.path.join(root, file), self.root))
+        return paths
+
+    def restore(self):
+        """Put every saved file back and empty the snapshot; return the restored paths."""
+        restored = self.files()
+        for relative in restored:
+            os.replace(os.path.join(self.root, relative), os.path.join(self.base, relative))
+            logging.info(f"Restored {relative}")
+        shutil.rmtree(self.root, ignore_errors=True)
+        return restored
+
+    def diff(self, context=3):
+        """Yield unified diff lines between every saved file and its current contents."""
+        for relative in self.files():
+            current = os.path.join(self.base, relative)
+            with open(os.path.join(self.root, relative)) as file:
+                before = file.readlines()
+            after = []
+            if os.path.exists(current):
+                with open(current) as file:
+                    after = file.readlines()
+            yield from difflib.unified_diff(before, after, f"a/{relative}", f"b/{relative}", n=context)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List, diff or restore the files a patch run saved")
+    parser.add_argument("command", choices=["list", "diff", "restore"])
+    parser.add_argument("root", help="snapshot directory given to the patch scripts' --snapshot")
+    parser.add_argument("--base", help="directory the patched paths are relative to (default: current)")
+    args = parser.parse_args()
+
+    snapshot = Snapshot(args.root, args.base)
+    if args.command == "list":
+        for relative in snapshot.files():
+            print(relative)
+    elif args.command == "diff":
+        sys.stdout.writelines(snapshot.diff())
+    else:
+        logging.info(f"Restored {len(snapshot.restore())} files from {args.root}")
@@ -0,0 +1,151 @@
+"""Build minimal dex images for tests.
+
+Only the sections ``dex_index.DexFile`` and ``dex_patch.DexPatcher`` read are
+written: strings, types, protos, methods, class defs, class data and code
+items (with their try blocks and catch handlers).
+"""
+import hashlib
+import struct
+import zlib
+
+from dex_index import HEADER
+
+OBJECT = "Ljava/lang/Object;"
+ACC_PUBLIC = 0x1
+ACC_STATIC = 0x8
+
+
+class Code:
+    """A code item; pass the same instance to several methods to make them share it.
+
+    ``tries`` is a list of ``(start_addr, insn_count, catch_all_addr)``;
+    every try block gets its own catch-all handler.
+    """
+
+    def __init__(self, registers, ins, insns, tries=(), debug_info_off=0):
+        self.registers = registers
+        self.ins = ins
+        self.insns = list(insns)
+        self.tries = list(tries)
+        self.debug_info_off = debug_info_off
+        self.offset = None
+
+
+def uleb128(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def shorty(return_type, parameters):
+    return "".join("L" if descriptor[0] in "L[" else descriptor for descriptor in [return_type, *parameters])
+
+
+def build_dex(classes):
+    """Return a dex image of ``classes``: ``{descriptor: [(name, return_type, parameters, access_flags, code)]}``.
+
+    ``code`` is a ``Code`` or ``None`` for an abstract method.
+    """
+    strings, types, protos = set(), {OBJECT}, set()
+    for descriptor, methods in classes.items():
+        types.add(descriptor)
+        for name, return_type, parameters, _, _ in methods:
+            strings.add(name)
+            types.update([return_type, *parameters])
+            protos.add((shorty(return_type, parameters), return_type, tuple(parameters)))
+    strings = sorted(strings | types | {proto[0] for proto in protos})
+    string_index = {string: i for i, string in enumerate(strings)}
+    types = sorted(types, key=string_index.get)
+    type_index = {descriptor: i for i, descriptor in enumerate(types)}
+    protos = sorted(protos, key=lambda proto: (type_index[proto[1]], [type_index[t] for t in proto[2]]))
+    proto_index = {proto: i for i, proto in enumerate(protos)}
+    method_ids = sorted(
+        (type_index[descriptor], string_index[name],
+         proto_index[(shorty(return_type, parameters), return_type, tuple(parameters))], descriptor, flags, code)
+        for descriptor, methods in classes.items() for name, return_type, parameters, flags, code in methods)
+
+    string_ids_off = HEADER.size
+    type_ids_off = string_ids_off + 4 * len(strings)
+    proto_ids_off = type_ids_off + 4 * len(types)
+    method_ids_off = proto_ids_off + 12 * len(protos)
+    class_defs_off = method_ids_off + 8 * len(method_ids)
+    data_off = class_defs_off + 32 * len(classes)
+    data = bytearray()
+
+    def align4():
+        data.extend(b"\0" * (-(data_off + len(data)) % 4))
+
+    type_lists = {}
+    for _, _, parameters in protos:
+        if parameters and parameters not in type_lists:
+            align4()
+            type_lists[parameters] = data_off + len(data)
+            data.extend(struct.pack(f"<I{len(parameters)}H", len(parameters), *map(type_index.get, parameters)))
+
+    for *_, code in method_ids:
+        if code is None or code.offset is not None:
+            continue
+        align4()
+        code.offset = data_off + len(data)
+        data.extend(struct.pack("<4H2I", code.registers, code.ins, 0, len(code.tries), code.debug_info_off,
+                                len(code.insns)))
+        data.extend(struct.pack(f"<{len(code.insns)}H", *code.insns))
+        if code.tries:
+            if len(code.insns) % 2:
+                data.extend(b"\0\0")
+            handlers = bytearray(uleb128(len(code.tries)))
+            handler_offsets = []
+            for _, _, catch_all_addr in code.tries:
+                handler_offsets.append(len(handlers))
+                # size 0 (sleb128): no typed catches, only a catch-all
+                handlers.extend(b"\0" + uleb128(catch_all_addr))
+            for (start_addr, insn_count, _), handler_off in zip(code.tries, handler_offsets):
+                data.extend(struct.pack("<IHH", start_addr, insn_count, handler_off))
+            data.extend(handlers)
+
+    class_data = {}
+    for descriptor in classes:
+        members = [(i, flags, code) for i, (_, _, _, owner, flags, code) in enumerate(method_ids)
+                   if owner == descriptor]
+        direct = [member for member in members if member[1] & ACC_STATIC]
+        virtual = [member for member in members if not member[1] & ACC_STATIC]
+        class_data[descriptor] = data_off + len(data)
+        data.extend(uleb128(0) + uleb128(0) + uleb128(len(direct)) + uleb128(len(virtual)))
+        for group in (direct, virtual):
+            previous = 0
+            for method_idx, flags, code in group:
+                data.extend(uleb128(method_idx - previous) + uleb128(flags) + uleb128(code.offset if code else 0))
+                previous = method_idx
+
+    string_data = []
+    for string in strings:
+        string_data.append(data_off + len(data))
+        data.extend(uleb128(len(string)) + string.encode() + b"\0")
+    align4()
+    map_off = data_off + len(data)
+    data.extend(struct.pack("<I", 1) + struct.pack("<HHII", 0x1000, 0, 1, map_off))
+
+    ids = bytearray(struct.pack(f"<{len(strings)}I", *string_data))
+    ids.extend(struct.pack(f"<{len(types)}I", *(string_index[descriptor] for descriptor in types)))
+    for proto in protos:
+        ids.extend(struct.pack("<3I", string_index[proto[0]], type_index[proto[1]], type_lists.get(proto[2], 0)))
+    for class_idx, name_idx, proto_idx, *_ in method_ids:
+        ids.extend(struct.pack("<HHI", class_idx, proto_idx, name_idx))
+    for descriptor in classes:
+        ids.extend(struct.pack("<8I", type_index[descriptor], ACC_PUBLIC, type_index[OBJECT], 0, 0xffffffff, 0,
+                               class_data[descriptor], 0))
+
+    size = HEADER.size + len(ids) + len(data)
+    image = bytearray(HEADER.pack(
+        b"dex\n035\0", 0, b"\0" * 20, size, HEADER.size, 0x12345678, 0, 0, map_off,
+        len(strings), string_ids_off, len(types), type_ids_off, len(protos), proto_ids_off, 0, 0,
+        len(method_ids), method_ids_off, len(classes), class_defs_off, len(data), data_off)) + ids + data
+    image[12:32] = hashlib.sha1(image[32:]).digest()
+    image[8:12] = struct.pack("<I", zlib.adler32(image[12:]))
+    return bytes(image)
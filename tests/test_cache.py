@@ -0,0 +1,25 @@
+import os
+
+from cache import ResultCache, SmaliTreeCache
+
+
+def test_stores_share_one_size_cap(tmp_path):
+    cache_dir, source_dir = tmp_path / "cache", tmp_path / "sources"
+    (source_dir / "tree").mkdir(parents=True)
+    results = ResultCache(str(cache_dir), 2500)
+    trees = SmaliTreeCache(str(cache_dir), 2500, str(tmp_path / "missing-baksmali.jar"))
+    result = source_dir / "result"
+    result.write_bytes(b"\0" * 1000)
+    # Random bytes, so the zipped tree stays about 1000 bytes
+    (source_dir / "tree" / "A.smali").write_bytes(os.urandom(1000))
+
+    results.store("old", str(result))
+    os.utime(results.path("old"), (100, 100))
+    trees.store("tree", str(source_dir / "tree"))
+    os.utime(trees.path("tree"), (200, 200))
+    results.store("new", str(result))
+
+    # Either store alone is under the cap; together they are over it, and the oldest entry goes
+    assert not os.path.exists(results.path("old"))
+    assert os.path.exists(results.path("new")) and os.path.exists(trees.path("tree"))
+    assert sum(size for _, size, _ in results.entries()) <= 2500
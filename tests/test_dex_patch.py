@@ -0,0 +1,143 @@
+import hashlib
+import os
+import struct
+import zipfile
+import zlib
+from argparse import Namespace
+
+import pytest
+
+import dex_patch
+import patcher
+from dex_builder import ACC_PUBLIC, ACC_STATIC, Code, build_dex
+from dex_patch import CODE_ITEM, UnsupportedRule, patch_dex_data
+from patch_engine import MethodBodyRule, PatchEngine
+
+CLASS = "Lcom/example/Target;"
+CLASS_FILE = "com/example/Target.smali"
+
+# const/4 v0, 0x1; const/4 v1, 0x2; add-int/lit8 v0, v1, 0x1; return v0
+INSNS = [0x1012, 0x2112, 0x00d8, 0x0101, 0x000f]
+# The replacement below: const/4 v0, 0x0; return v0
+REPLACEMENT = [0x0012, 0x000f]
+
+
+def rule(method="check"):
+    body = ["    .registers 3\n", "    const/4 v0, 0x0\n", "    return v0\n"]
+    return MethodBodyRule({method: (rf"\.method.*{method}\(I\)Z", body)}, keep_registers=False, name="modify_file")
+
+
+def code_item(data, code_off):
+    registers_size, ins_size, outs_size, tries_size, debug_info_off, insns_size = CODE_ITEM.unpack_from(data, code_off)
+    insns = list(struct.unpack_from(f"<{insns_size}H", data, code_off + CODE_ITEM.size))
+    return registers_size, ins_size, tries_size, debug_info_off, insns
+
+
+def assert_valid_header(data):
+    assert data[12:32] == hashlib.sha1(data[32:]).digest()
+    assert struct.unpack_from("<I", data, 8)[0] == zlib.adler32(data[12:])
+
+
+def test_body_is_written_over_insns_and_nop_filled():
+    code = Code(4, 1, INSNS, tries=[(0, 4, 4)], debug_info_off=0x1234)
+    data = build_dex({CLASS: [("check", "Z", ["I"], ACC_PUBLIC | ACC_STATIC, code)]})
+
+    patched, stats = patch_dex_data(data, {CLASS_FILE: [rule()]}, "classes.dex")
+
+    assert stats == {"modify_file": 1}
+    registers_size, ins_size, tries_size, debug_info_off, insns = code_item(patched, code.offset)
+    assert insns == REPLACEMENT + [dex_patch.NOP] * (len(INSNS) - len(REPLACEMENT))
+    assert (registers_size, ins_size, tries_size, debug_info_off) == (4, 1, 1, 0)
+    assert len(patched) == len(data)
+
+
+def test_try_blocks_and_everything_else_are_preserved():
+    code = Code(4, 1, INSNS, tries=[(0, 2, 4), (2, 2, 4)], debug_info_off=0x1234)
+    data = build_dex({CLASS: [("check", "Z", ["I"], ACC_PUBLIC | ACC_STATIC, code),
+                              ("other", "V", [], ACC_PUBLIC, Code(1, 1, [0x000e]))]})
+
+    patched, _ = patch_dex_data(data, {CLASS_FILE: [rule()]}, "classes.dex")
+
+    # Only the code item's debug_info_off and insns change, besides the header's signature and checksum
+    expected = bytearray(data)
+    struct.pack_into("<I", expected, code.offset + 8, 0)
+    struct.pack_into(f"<{len(INSNS)}H", expected, code.offset + CODE_ITEM.size,
+                     *REPLACEMENT, *[dex_patch.NOP] * (len(INSNS) - len(REPLACEMENT)))
+    assert patched[32:] == bytes(expected[32:])
+
+
+def test_signature_and_checksum_are_recomputed():
+    data = build_dex({CLASS: [("check", "Z", ["I"], ACC_PUBLIC | ACC_STATIC, Code(4, 1, INSNS))]})
+    assert_valid_header(data)
+
+    patched, _ = patch_dex_data(data, {CLASS_FILE: [rule()]}, "classes.dex")
+
+    assert patched[8:32] != data[8:32]
+    assert_valid_header(patched)
+
+
+def test_unmatched_rule_leaves_image_alone():
+    data = build_dex({CLASS: [("other", "Z", ["I"], ACC_PUBLIC | ACC_STATIC, Code(4, 1, INSNS))]})
+
+    patched, stats = patch_dex_data(data, {CLASS_FILE: [rule()]}, "classes.dex")
+
+    assert patched is None
+    assert not stats
+
+
+def test_too_short_code_item_is_unsupported():
+    # return v0: one code unit, too short for the two-unit replacement
+    data = build_dex({CLASS: [("check", "Z", ["I"], ACC_PUBLIC | ACC_STATIC, Code(1, 1, [0x000f]))]})
+
+    with pytest.raises(UnsupportedRule, match="too short"):
+        patch_dex_data(data, {CLASS_FILE: [rule()]}, "classes.dex")
+
+
+def test_shared_code_item_is_unsupported():
+    shared = Code(4, 1, INSNS)
+    data = build_dex({CLASS: [("check", "Z", ["I"], ACC_PUBLIC | ACC_STATIC, shared),
+                              ("copy", "Z", ["I"], ACC_PUBLIC | ACC_STATIC, shared)]})
+
+    with pytest.raises(UnsupportedRule, match="shared"):
+        patch_dex_data(data, {CLASS_FILE: [rule()]}, "classes.dex")
+
+
+class FakeTools:
+    """Stands in for baksmali/smali: disassembles to one smali class and records assembly."""
+
+    def __init__(self):
+        self.assembled = []
+
+    def disassemble(self, dex_path, output_dir, api_level):
+        path = f"{output_dir}/{CLASS_FILE}"
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w") as file:
+            file.write(".method public static check(I)Z\n    .registers 4\n    const/4 v0, 0x1\n    return v0\n"
+                       ".end method\n")
+
+    def assemble(self, input_dir, dex_path, api_level):
+        self.assembled.append(input_dir)
+        with open(dex_path, "wb") as file:
+            file.write(b"assembled")
+
+
+def test_unsupported_code_item_falls_back_to_smali(tmp_path, caplog):
+    data = build_dex({CLASS: [("check", "Z", ["I"], ACC_PUBLIC | ACC_STATIC, Code(1, 1, [0x000f]))]})
+    jar_path = tmp_path / "framework.jar"
+    with zipfile.ZipFile(jar_path, "w") as jar:
+        jar.writestr("classes.dex", data)
+    engine = PatchEngine()
+    engine.register(CLASS_FILE, rule())
+    # A target in another dex: the fallback must not look for it in this dex's smali
+    engine.register("com/example/Elsewhere.smali", rule())
+    tools = FakeTools()
+    extract_dir, directory = tmp_path / "framework", tmp_path / "classes"
+    extract_dir.mkdir()
+
+    patcher.patch_dex_directly(tools, engine, str(jar_path), "classes.dex", {CLASS_FILE: [rule()]},
+                               str(extract_dir), str(directory), Namespace(jobs=1, api_level="34"))
+
+    assert tools.assembled == [str(directory)]
+    assert (extract_dir / "classes.dex").read_bytes() == b"assembled"
+    assert "const/4 v0, 0x0" in (directory / CLASS_FILE).read_text()
+    assert "Class not found" not in caplog.text
@@ -0,0 +1,131 @@
+import io
+import struct
+import zipfile
+
+import pytest
+
+from jar_writer import (ALIGNMENT, ALIGNMENT_EXTRA_ID, DATA_DESCRIPTOR_FLAG, LOCAL_HEADER, PAGE_ALIGNMENT,
+                        changed_dex_entries, write_jar)
+
+ENTRIES = [
+    ("META-INF/MANIFEST.MF", zipfile.ZIP_DEFLATED, b"Manifest-Version: 1.0\r\n"),
+    ("classes.dex", zipfile.ZIP_STORED, b"dex\n035\0" + bytes(range(256)) * 3),
+    # An odd-length name and data, so the stored entries after it need padding
+    ("res/a.xml", zipfile.ZIP_DEFLATED, b"<xml/>" * 101),
+    ("classes2.dex", zipfile.ZIP_STORED, b"dex\n035\0" + b"\x01" * 1001),
+    ("lib/arm64-v8a/libx.so", zipfile.ZIP_STORED, b"\x7fELF" + b"\0" * 333),
+]
+
+
+class Unseekable(io.RawIOBase):
+    """A write-only stream that cannot seek, so ``zipfile`` writes data descriptors."""
+
+    def __init__(self, output):
+        self.output = output
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.output.write(data)
+
+
+def make_jar(path, data_descriptors):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(Unseekable(buffer) if data_descriptors else buffer, "w") as jar:
+        for name, compress_type, data in ENTRIES:
+            jar.writestr(zipfile.ZipInfo(name, (2008, 1, 1, 0, 0, 0)), data, compress_type)
+    path.write_bytes(buffer.getvalue())
+    with zipfile.ZipFile(path) as jar:
+        assert all(bool(info.flag_bits & DATA_DESCRIPTOR_FLAG) == data_descriptors for info in jar.infolist())
+
+
+def data_offset(data, info):
+    """Where ``info``'s data starts, and the alignment its 0xD935 extra field records (``None`` without one)."""
+    header = LOCAL_HEADER.unpack_from(data, info.header_offset)
+    name_length, extra_length = header[9], header[10]
+    extra_start = info.header_offset + LOCAL_HEADER.size + name_length
+    extra = data[extra_start:extra_start + extra_length]
+    alignment = None
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from("<HH", extra, offset)
+        if header_id == ALIGNMENT_EXTRA_ID:
+            alignment = struct.unpack_from("<H", extra, offset + 4)[0]
+        offset += 4 + size
+    return extra_start + extra_length, alignment
+
+
+def check_jar(path, replacements):
+    data = path.read_bytes()
+    with zipfile.ZipFile(path) as jar:
+        assert jar.testzip() is None
+        assert [info.filename for info in jar.infolist()] == [name for name, _, _ in ENTRIES]
+        for (name, compress_type, contents), info in zip(ENTRIES, jar.infolist()):
+            assert info.compress_type == compress_type
+            assert not info.flag_bits & DATA_DESCRIPTOR_FLAG
+            assert jar.read(name) == replacements.get(name, contents)
+            offset, alignment = data_offset(data, info)
+            if compress_type == zipfile.ZIP_STORED:
+                expected = PAGE_ALIGNMENT if name.endswith(".so") else ALIGNMENT
+                assert alignment == expected
+                assert offset % expected == 0
+            else:
+                assert alignment is None
+
+
+@pytest.mark.parametrize("data_descriptors", [False, True])
+def test_copy_aligns_stored_entries(tmp_path, data_descriptors):
+    source, output = tmp_path / "stock.jar", tmp_path / "out.jar"
+    make_jar(source, data_descriptors)
+
+    write_jar(str(source), str(output))
+
+    check_jar(output, {})
+
+
+@pytest.mark.parametrize("data_descriptors", [False, True])
+def test_replaced_entries_keep_their_compression(tmp_path, data_descriptors):
+    source, output = tmp_path / "stock.jar", tmp_path / "out.jar"
+    make_jar(source, data_descriptors)
+    dex = tmp_path / "classes2.dex"
+    dex.write_bytes(b"dex\n035\0" + b"\x02" * 4097)
+    replacements = {"classes.dex": b"dex\n035\0patched", "res/a.xml": b"<patched/>" * 7,
+                    "classes2.dex": dex.read_bytes()}
+
+    write_jar(str(source), str(output), {"classes.dex": replacements["classes.dex"],
+                                         "res/a.xml": replacements["res/a.xml"], "classes2.dex": str(dex)})
+
+    check_jar(output, replacements)
+
+
+def test_realigning_an_aligned_jar_is_stable(tmp_path):
+    source, once, twice = tmp_path / "stock.jar", tmp_path / "once.jar", tmp_path / "twice.jar"
+    make_jar(source, True)
+
+    write_jar(str(source), str(once))
+    write_jar(str(once), str(twice))
+
+    assert once.read_bytes() == twice.read_bytes()
+
+
+def test_changed_dex_entries(tmp_path):
+    source = tmp_path / "stock.jar"
+    make_jar(source, False)
+    dex_dir = tmp_path / "dex"
+    dex_dir.mkdir()
+    (dex_dir / "classes.dex").write_bytes(ENTRIES[1][2])
+    (dex_dir / "classes2.dex").write_bytes(b"dex\n035\0changed")
+
+    assert changed_dex_entries(str(source), str(dex_dir)) == {"classes2.dex": str(dex_dir / "classes2.dex")}
+
+
+def test_unknown_replacement_is_an_error(tmp_path):
+    source, output = tmp_path / "stock.jar", tmp_path / "out.jar"
+    make_jar(source, False)
+
+    with pytest.raises(KeyError, match="classes3.dex"):
+        write_jar(str(source), str(output), {"classes3.dex": b"dex"})
+
+    assert not output.exists()
+    assert not (tmp_path / "out.jar.tmp").exists()
@@ -0,0 +1,57 @@
+import os
+
+from method_index import MethodIndex
+from patch_engine import MethodBodyRule, patch_file
+
+CLASS = (".class public Lcom/example/Target;\n.super Ljava/lang/Object;\n\n"
+         ".method public static check(I)Z\n    .registers 4\n    const/4 v0, 0x1\n    return v0\n.end method\n\n"
+         ".method public static other()V\n    .registers 1\n    return-void\n.end method\n\n"
+         ".method public static verify(I)Z\n    .registers 4\n    const/4 v0, 0x1\n    return v0\n.end method\n")
+
+
+def rule(method):
+    body = ["    .registers 3\n", "    const/4 v0, 0x0\n", "    nop\n", "    return v0\n"]
+    return MethodBodyRule({method: (rf"\.method.*{method}\(I\)Z", body)}, keep_registers=False, name=method)
+
+
+def write_class(tmp_path):
+    tree = tmp_path / "classes"
+    path = tree / "com/example/Target.smali"
+    path.parent.mkdir(parents=True)
+    path.write_text(CLASS)
+    return tree, path
+
+
+def test_build_finds_every_method():
+    data = CLASS.encode()
+
+    index = MethodIndex.build(data)
+
+    assert len(index) == 3
+    for start, end in index:
+        assert data[start:].startswith(b".method")
+        assert data[end:].startswith(b".end method")
+
+
+def test_spliced_index_matches_a_fresh_scan():
+    data = CLASS.encode()
+    index = MethodIndex.build(data)
+    body_start = data.index(b"    .registers 4")
+    body_end = data.index(b".end method")
+    edits = [(body_start, body_end, b"    .registers 1\n    return-void\n    nop\n    nop\n")]
+
+    spliced = data[:body_start] + edits[0][2] + data[body_end:]
+
+    assert list(index.spliced(edits)) == list(MethodIndex.build(spliced))
+
+
+def test_consecutive_splices_leave_only_the_class_in_the_tree(tmp_path):
+    tree, path = write_class(tmp_path)
+
+    stats = patch_file(str(path), [rule("check"), rule("verify")])
+
+    assert stats == {"check": 1, "verify": 1}
+    text = path.read_text()
+    assert text.count("    nop\n") == 2 and "const/4 v0, 0x1" not in text
+    assert [os.path.relpath(os.path.join(root, file), tree)
+            for root, _, files in os.walk(tree) for file in files] == ["com/example/Target.smali"]
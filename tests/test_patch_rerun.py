@@ -0,0 +1,60 @@
+import os
+
+from patch_engine import write_manifest
+from patcher import load_script
+
+RECORD = "android/media/MediaRouter2$PackageNameUserHandlePair.smali"
+PLAIN = "android/hardware/input/PhysicalKeyLayout$EnterKey.smali"
+
+
+def record_class(descriptor, invoke_custom=True):
+    body = ("    invoke-custom {p0, p1}, call_site_0(Ljava/lang/Object;)Z\n    move-result v0\n"
+            if invoke_custom else "    const/4 v0, 0x1\n")
+    methods = [f".method public final {declaration}\n    .registers 2\n{body}    return v0\n.end method\n\n"
+               for declaration in ["equals(Ljava/lang/Object;)Z", "hashCode()I", "toString()Ljava/lang/String;"]]
+    return f".class public final L{descriptor};\n.super Ljava/lang/Record;\n\n" + "".join(methods)
+
+
+def write_tree(root):
+    classes = root / "classes"
+    for class_file, invoke_custom in [(RECORD, True), (PLAIN, False)]:
+        path = classes / class_file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(record_class(class_file[:-len(".smali")], invoke_custom))
+    return [str(classes)]
+
+
+def run(directories, manifest_path):
+    changed = []
+    load_script("framework_patch.py").modify_smali_files(directories, False, changed=changed)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    write_manifest(manifest_path, changed)
+    with open(manifest_path) as manifest:
+        return manifest.read().splitlines()
+
+
+def test_rerun_lists_prepatched_files_in_the_manifest(tmp_path):
+    directories = write_tree(tmp_path)
+    manifest_path = str(tmp_path / "manifest.txt")
+    record_path = os.path.join(directories[0], RECORD)
+
+    first = run(directories, manifest_path)
+    patched = open(record_path).read()
+    second = run(directories, manifest_path)
+
+    assert "invoke-custom" not in patched
+    assert os.path.normpath(record_path).replace(os.sep, "/") in first
+    assert second == first
+    assert open(record_path).read() == patched
+
+
+def test_file_without_required_text_is_left_alone(tmp_path):
+    directories = write_tree(tmp_path)
+    plain_path = os.path.join(directories[0], PLAIN)
+    original = open(plain_path).read()
+
+    manifest = run(directories, str(tmp_path / "manifest.txt"))
+
+    assert open(plain_path).read() == original
+    assert os.path.normpath(plain_path).replace(os.sep, "/") not in manifest
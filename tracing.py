@@ -0,0 +1,143 @@
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import Counter
+
+
+class Tracer:
+    """Records timed spans with counters for a run report and a Chrome trace.
+
+    Spans nest per thread; when a span ends its counters are added to the
+    span enclosing it, so a stage reports the bytes and lines of every file
+    it patched. ``child_cpu`` counts CPU spent outside the current thread
+    (subprocesses, worker processes) and is included in a span's ``cpu``.
+    Nothing is recorded until ``enabled`` is set.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, category="stage", **args):
+        if not self.enabled:
+            yield Counter()
+            return
+        stack = self._stack()
+        counters = Counter()
+        stack.append(counters)
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield counters
+        finally:
+            cpu = time.thread_time() - cpu_start + counters["child_cpu"]
+            wall = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1].update(counters)
+            self._record({"name": name, "cat": category, "start": start, "wall": wall, "cpu": cpu,
+                          "pid": os.getpid(), "tid": threading.get_ident(), "depth": len(stack),
+                          "args": args, "counters": dict(counters)})
+
+    def count(self, **values):
+        """Add ``values`` to the innermost open span's counters."""
+        stack = self._stack() if self.enabled else None
+        if stack:
+            stack[-1].update(values)
+
+    def _record(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def drain(self):
+        with self.lock:
+            spans, self.spans = self.spans, []
+        return spans
+
+    def merge(self, spans):
+        """Add spans recorded in another process, charging their top-level counters to the open span."""
+        if not self.enabled:
+            return
+        stack = self._stack()
+        for span in spans:
+            if span["depth"] == 0 and stack:
+                stack[-1].update(span["counters"])
+                stack[-1]["child_cpu"] += span["cpu"] - span["counters"].get("child_cpu", 0)
+            self._record(dict(span, depth=span["depth"] + len(stack)))
+
+    def report(self):
+        spans = sorted(self.spans, key=lambda span: span["start"])
+        origin = spans[0]["start"] if spans else 0
+        totals = {}
+        for span in spans:
+            total = totals.setdefault(span["cat"], {}).setdefault(span["name"], Counter())
+            total.update(span["counters"])
+            total.update(count=1, wall=span["wall"], cpu=span["cpu"])
+        return {
+            "wall": max((span["start"] + span["wall"] for span in spans), default=origin) - origin,
+            "totals": {category: {name: dict(total) for name, total in names.items()}
+                       for category, names in totals.items()},
+            "spans": [dict(span, start=span["start"] - origin) for span in spans],
+        }
+
+    def chrome_trace(self):
+        spans = sorted(self.spans, key=lambda span: span["start"])
+        origin = spans[0]["start"] if spans else 0
+        return {"traceEvents": [{
+            "name": span["name"], "cat": span["cat"], "ph": "X",
+            "ts": round((span["start"] - origin) * 1e6), "dur": round(span["wall"] * 1e6),
+            "pid": span["pid"], "tid": span["tid"],
+            "args": dict(span["args"], cpu_ms=round(span["cpu"] * 1e3, 3), **span["counters"]),
+        } for span in spans]}
+
+
+tracer = Tracer()
+span = tracer.span
+count = tracer.count
+
+
+def run(command, cwd=None, stdout=subprocess.DEVNULL):
+    """``subprocess.run(command, check=True)`` that charges the child's CPU time to the open span."""
+    with span(os.path.basename(command[0]), "command", command=" ".join(command)):
+        process = subprocess.Popen(command, cwd=cwd, stdout=stdout)
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        count(child_cpu=usage.ru_utime + usage.ru_stime)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def tree_size(path):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, dirs, files in os.walk(path) for file in files)
+
+
+def add_arguments(parser):
+    parser.add_argument("--trace-report", help="write per-stage and per-file timings and counters to this JSON file")
+    parser.add_argument("--chrome-trace", help="also write a Chrome trace-event file (chrome://tracing, Perfetto)")
+
+
+def configure(args):
+    tracer.enabled = bool(args.trace_report or args.chrome_trace)
+
+
+def write_outputs(args):
+    if args.trace_report:
+        with open(args.trace_report, 'w') as file:
+            json.dump(tracer.report(), file, indent=2)
+        logging.info(f"Wrote trace report: {args.trace_report}")
+    if args.chrome_trace:
+        with open(args.chrome_trace, 'w') as file:
+            json.dump(tracer.chrome_trace(), file)
+        logging.info(f"Wrote Chrome trace: {args.chrome_trace}")